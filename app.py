@@ -1,9 +1,31 @@
 import os
+import threading
+import time
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from flask_cors import CORS
 from models import setup_db, Artist, Album, db
-from auth import AuthError, requires_auth
+from auth import AuthError, requires_auth, route_scopes
+from pagination import get_page_args, get_fields, get_sort, keyset_page, \
+    column_query
+from serialization import ARROW, ENCODERS, LIST_FORMATS, json_response, \
+    encoded_response, negotiate
+from export import export_response, arrow_page
+from bulk import get_bulk_items, bulk_create, bulk_update, bulk_delete
+from search import get_search_args, search_catalogue
+from catalogue import get_album_filters, get_group, album_counts
+from stats import catalogue_stats
+from response_cache import response_cache
+from compression import Compression
+from instrumentation import Instrumentation
+from metrics import Metrics
+from replicas import read_only
+from idempotency import idempotent
+from warmup import log_boot
+from conditional import conditional, collection_state, row_state, row_etag, \
+    matches_if_match
 
 
 def create_app(test_config=None):
@@ -11,33 +33,91 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
 
+    # per request timing and metrics, registered first so they also
+    # cover compression
+    Instrumentation(app)
+    Metrics(app)
+
     # setup cross origin
     CORS(app)
 
+    # gzip/brotli for large and streamed responses
+    Compression(app)
+
     # Setup home route
     @app.route('/')
     def welcome():
         return 'Welcome to music store.'
 
+    # Route listing every route with the permission it requires
+    @app.route('/scopes')
+    @requires_auth('get:scopes')
+    def get_scopes(jwt):
+        return json_response({
+            'success': True,
+            'routes': route_scopes(app)
+        })
+
     """Albums Routes"""
 
     # Route for getting all albums
     @app.route('/albums')
+    @read_only
     @requires_auth('get:albums')
+    @response_cache.cached(lambda: ['albums'])
+    @conditional(lambda: collection_state(Album))
     def get_albums(jwt):
-        """Get all albums"""
+        """Get albums, paginated with ?limit= and ?after=,
+        filtered by ?artist=, ?year_from=, ?year_to= and ordered by ?sort="""
 
-        albums = Album.query.all()
-        formatted_albums = [album.format() for album in albums]
+        limit, after = get_page_args(request.args)
+        fields = get_fields(request.args, Album)
+        criteria = get_album_filters(request.args)
+        order = get_sort(request.args, Album)
+        mimetype = negotiate()
+        if mimetype == ARROW:
+            return arrow_page(Album, fields, limit, after, criteria, order)
 
-        return jsonify({
+        albums, next_cursor = keyset_page(Album, fields, limit, after,
+                                          criteria, order)
+
+        return encoded_response({
             'success': True,
-            'albums': formatted_albums
-        }), 200
+            'albums': albums,
+            'next_cursor': next_cursor
+        }, mimetype)
+
+    # Route for counting albums per year or per artist
+    @app.route('/albums/counts')
+    @read_only
+    @requires_auth('get:albums')
+    @response_cache.cached(lambda: ['albums'])
+    @conditional(lambda: collection_state(Album))
+    def get_album_counts(jwt):
+        by = get_group(request.args)
+        criteria = get_album_filters(request.args)
+
+        return json_response({
+            'success': True,
+            'by': by,
+            'counts': album_counts(by, criteria)
+        })
+
+    # Route for streaming the whole album catalogue
+    @app.route('/albums/export')
+    @read_only
+    @requires_auth('get:albums')
+    def export_albums(jwt):
+        export_format = request.args.get('format', 'ndjson')
+
+        return export_response(Album, 'albums', export_format)
 
     # Route for getting a specific album
     @app.route('/albums/<int:id>')
+    @read_only
     @requires_auth('get:albums')
+    @response_cache.cached(lambda id: ['album', f'album:{id}'])
+    @conditional(lambda id: row_state(Album, id))
     def get_album_by_id(jwt, id):
         album = Album.query.filter(Album.id == id).one_or_none()
 
@@ -45,13 +125,14 @@ def create_app(test_config=None):
         if album is None:
             abort(404)
         else:
-            return jsonify({
+            return json_response({
                 'success': True,
                 'album': album.format(),
-            }), 200
+            })
 
     @app.route('/albums', methods=['POST'])
     @requires_auth('post:albums')
+    @idempotent()
     def post_album(jwt):
         # Process request data
         data = request.get_json()
@@ -66,10 +147,15 @@ def create_app(test_config=None):
         try:
             album = Album(title=title, year=year, artist=artist)
             album.insert()
+            response_cache.invalidate('albums')
             return jsonify({
                 'success': True,
                 'album': album.format()
             }), 201
+        except IntegrityError:
+            # an album with this title already exists
+            db.session.rollback()
+            abort(409)
         except Exception:
             abort(500)
 
@@ -79,11 +165,18 @@ def create_app(test_config=None):
 
         data = request.get_json()
 
-        album = Album.query.filter(Album.id == id).one_or_none()
+        # lock the row while If-Match is checked against its version
+        query = Album.query.filter(Album.id == id)
+        if request.if_match:
+            query = query.with_for_update()
+        album = query.one_or_none()
 
         if album is None:
             abort(404)
 
+        if not matches_if_match(row_etag(album)):
+            abort(412)
+
         try:
 
             if 'title' in data:
@@ -94,8 +187,10 @@ def create_app(test_config=None):
 
             if 'artist' in data:
                 album.artist = data.get('artist')
+                album.link_artist()
 
             album.update()
+            response_cache.invalidate('albums', f'album:{id}')
             return jsonify({
                 'success': True,
                 'album': album.format()
@@ -112,6 +207,7 @@ def create_app(test_config=None):
             abort(404)
         try:
             album.delete()
+            response_cache.invalidate('albums', f'album:{id}')
             return jsonify({
                 'success': True,
                 'deleted': id,
@@ -120,35 +216,138 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(500)
 
+    # Routes for writing many albums in chunked transactions
+    @app.route('/albums/bulk', methods=['POST'])
+    @requires_auth('post:albums')
+    def post_albums_bulk(jwt):
+        items = get_bulk_items(request.get_json())
+        results = bulk_create(Album, items)
+        response_cache.invalidate('albums')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/albums/bulk', methods=['PATCH'])
+    @requires_auth('patch:albums')
+    def patch_albums_bulk(jwt):
+        items = get_bulk_items(request.get_json())
+        results = bulk_update(Album, items)
+        response_cache.invalidate('albums', 'album')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/albums/bulk', methods=['DELETE'])
+    @requires_auth('delete:albums')
+    def delete_albums_bulk(jwt):
+        ids = get_bulk_items(request.get_json())
+        results = bulk_delete(Album, ids)
+        response_cache.invalidate('albums', 'album')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    # Route for the precomputed catalogue statistics
+    @app.route('/stats')
+    @read_only
+    @requires_auth('get:albums')
+    @response_cache.cached(lambda: ['albums'])
+    def get_stats(jwt):
+        return json_response(dict(catalogue_stats(), success=True))
+
     """Artists Routes"""
 
     @app.route('/artists')
+    @read_only
     @requires_auth('get:artists')
+    @response_cache.cached(
+        lambda: ['artists', 'albums']
+        if request.args.get('embed') == 'albums' else ['artists'])
+    @conditional(
+        lambda: collection_state(Artist, Album)
+        if request.args.get('embed') == 'albums'
+        else collection_state(Artist))
     def get_artists(jwt):
 
-        artists = Artist.query.all()
-        formatted_artists = [artist.format() for artist in artists]
-
-        return jsonify({
+        limit, after = get_page_args(request.args)
+        fields = get_fields(request.args, Artist)
+        embed = request.args.get('embed') == 'albums'
+
+        # nested albums have no columnar form
+        mimetype = negotiate(list(ENCODERS) if embed else LIST_FORMATS)
+        if mimetype == ARROW:
+            return arrow_page(Artist, fields, limit, after)
+
+        artists, next_cursor = keyset_page(Artist, fields, limit, after)
+
+        # embed albums with a single query for the whole page
+        if embed and artists:
+            albums_by_artist = {artist['id']: [] for artist in artists}
+            album_fields = Album.public_fields
+            albums = column_query(Album, album_fields) \
+                .filter(Album.artist_id.in_(list(albums_by_artist))) \
+                .order_by(Album.id)
+            for album in albums:
+                albums_by_artist[album.artist_id].append(
+                    dict(zip(album_fields, album)))
+            for artist in artists:
+                artist['albums'] = albums_by_artist[artist['id']]
+
+        return encoded_response({
             'success': True,
-            'artists': formatted_artists
-        }), 200
+            'artists': artists,
+            'next_cursor': next_cursor
+        }, mimetype)
+
+    @app.route('/artists/export')
+    @read_only
+    @requires_auth('get:artists')
+    def export_artists(jwt):
+        export_format = request.args.get('format', 'ndjson')
+
+        return export_response(Artist, 'artists', export_format)
 
     @app.route('/artists/<int:id>')
+    @read_only
     @requires_auth('get:artists')
+    @response_cache.cached(lambda id: ['artist', f'artist:{id}'])
+    @conditional(lambda id: row_state(Artist, id))
     def get_artist_by_id(jwt, id):
         artist = Artist.query.filter(Artist.id == id).one_or_none()
 
         if artist is None:
             abort(404)
         else:
-            return jsonify({
+            return json_response({
                 'success': True,
                 'artist': artist.format(),
-            }), 200
+            })
+
+    @app.route('/artists/<int:id>/albums')
+    @read_only
+    @requires_auth('get:albums')
+    def get_artist_albums(jwt, id):
+        artist = Artist.query.options(selectinload(Artist.albums)) \
+            .filter(Artist.id == id).one_or_none()
+
+        if artist is None:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'artist': artist.format(),
+            'albums': [album.format() for album in artist.albums]
+        })
 
     @app.route('/artists', methods=['POST'])
     @requires_auth('post:artists')
+    @idempotent()
     def post_artist(jwt):
         data = request.get_json()
         name = data.get('name', None)
@@ -160,6 +359,8 @@ def create_app(test_config=None):
 
         try:
             artist.insert()
+            # albums saved under the name get linked to the artist
+            response_cache.invalidate('artists', 'albums', 'album')
             return jsonify({
                 'success': True,
                 'artist': artist.format()
@@ -172,11 +373,19 @@ def create_app(test_config=None):
     def patch_artist(jwt, id):
         data = request.get_json()
         name = data.get('name', None)
-        artist = Artist.query.filter(Artist.id == id).one_or_none()
+
+        # lock the row while If-Match is checked against its version
+        query = Artist.query.filter(Artist.id == id)
+        if request.if_match:
+            query = query.with_for_update()
+        artist = query.one_or_none()
 
         if artist is None:
             abort(404)
 
+        if not matches_if_match(row_etag(artist)):
+            abort(412)
+
         if name is None:
             abort(400)
 
@@ -184,6 +393,8 @@ def create_app(test_config=None):
             if 'name' in data:
                 artist.name = name
             artist.update()
+            response_cache.invalidate(
+                'artists', f'artist:{id}', 'albums', 'album')
             return jsonify({
                 'success': True,
                 'artist': artist.format()
@@ -200,6 +411,9 @@ def create_app(test_config=None):
             abort(404)
         try:
             artist.delete()
+            # albums of the artist lose their artist_id
+            response_cache.invalidate(
+                'artists', f'artist:{id}', 'albums', 'album')
             return jsonify({
                 'success': True,
                 'deleted': id,
@@ -208,6 +422,59 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(500)
 
+    # Routes for writing many artists in chunked transactions
+    @app.route('/artists/bulk', methods=['POST'])
+    @requires_auth('post:artists')
+    def post_artists_bulk(jwt):
+        items = get_bulk_items(request.get_json())
+        results = bulk_create(Artist, items)
+        response_cache.invalidate('artists', 'albums', 'album')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/artists/bulk', methods=['PATCH'])
+    @requires_auth('patch:artists')
+    def patch_artists_bulk(jwt):
+        items = get_bulk_items(request.get_json())
+        results = bulk_update(Artist, items)
+        response_cache.invalidate('artists', 'artist', 'albums', 'album')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/artists/bulk', methods=['DELETE'])
+    @requires_auth('delete:artists')
+    def delete_artists_bulk(jwt):
+        ids = get_bulk_items(request.get_json())
+        results = bulk_delete(Artist, ids)
+        response_cache.invalidate('artists', 'artist', 'albums', 'album')
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    """Search Routes"""
+
+    # Route for ranked full text and typeahead search
+    @app.route('/search')
+    @read_only
+    @requires_auth('get:albums')
+    def search(jwt):
+        tokens, prefix, years, limit = get_search_args(request.args)
+        albums, artists = search_catalogue(tokens, prefix, years, limit)
+
+        return json_response({
+            'success': True,
+            'albums': albums,
+            'artists': artists
+        })
+
     # Error Handling
     @app.errorhandler(422)
     def unprocessable(error):
@@ -233,6 +500,30 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    @app.errorhandler(406)
+    def not_acceptable(error):
+        return jsonify({
+            "success": False,
+            "error": 406,
+            "message": "not acceptable"
+        }), 406
+
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -250,7 +541,32 @@ def create_app(test_config=None):
     return app
 
 
-APP = create_app()
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    '''
+    Returns the app of this process, created on first use so importing
+    this module has no side effects
+    '''
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                started = time.perf_counter()
+                _app = create_app()
+                log_boot('create_app', {'total_ms': round(
+                    (time.perf_counter() - started) * 1000, 3)})
+    return _app
+
+
+def __getattr__(name):
+    # app:APP, as used by gunicorn, resolves to the lazily created app
+    if name == 'APP':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    get_app().run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
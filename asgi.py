@@ -0,0 +1,205 @@
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import get_app
+from warmup import WARMUP, warm_up
+
+# threads running request handlers, slow clients do not hold one
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+# request bodies are buffered before a handler thread is used
+ASGI_MAX_BODY = int(os.environ.get('ASGI_MAX_BODY', 10 * 1024 * 1024))
+
+# responses up to this size are handed back to the event loop whole,
+# larger ones are streamed from the handler thread
+ASGI_BUFFER_SIZE = int(os.environ.get('ASGI_BUFFER_SIZE', 1024 * 1024))
+
+
+class AsgiApp:
+    """AsgiApp
+    Serves the Flask app over ASGI.
+
+    Reading the request and writing the response happen on the event
+    loop, so thousands of slow clients can be held by one process. The
+    handlers themselves, with their database session, run in a bounded
+    thread pool and share all validation, auth and formatting code with
+    the WSGI entry point.
+    """
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # fetch signing keys and open connections before the
+                # first request needs them
+                if WARMUP:
+                    await loop.run_in_executor(
+                        self.executor, warm_up, self.wsgi_app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        try:
+            body = await self.read_body(receive)
+        except ConnectionAbortedError:
+            return
+
+        if body is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 413,
+                'headers': [(b'content-type', b'text/plain')]
+            })
+            await send({
+                'type': 'http.response.body',
+                'body': b'Request Entity Too Large'
+            })
+            return
+
+        loop = asyncio.get_event_loop()
+        environ = self.build_environ(scope, body)
+        status, headers, chunks = await loop.run_in_executor(
+            self.executor, self.run_wsgi, environ, send, loop)
+
+        # buffered responses are written without holding a thread
+        if chunks is not None:
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers
+            })
+            await send({
+                'type': 'http.response.body',
+                'body': b''.join(chunks)
+            })
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionAbortedError()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > ASGI_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    def build_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+            .decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value \
+                    if key in environ else value
+        return environ
+
+    def run_wsgi(self, environ, send, loop):
+        '''
+        Runs the WSGI app in a handler thread. Small bodies are returned
+        to the event loop, larger or streamed bodies are sent chunk by
+        chunk from the thread so memory stays flat.
+        '''
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ]
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = []
+            size = 0
+            iterator = iter(result)
+            for chunk in iterator:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > ASGI_BUFFER_SIZE:
+                    break
+            else:
+                return response['status'], response['headers'], chunks
+
+            send_from_thread({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers']
+            })
+            for chunk in chunks:
+                send_from_thread({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True
+                })
+            for chunk in iterator:
+                if chunk:
+                    send_from_thread({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True
+                    })
+            send_from_thread({'type': 'http.response.body', 'body': b''})
+            return response['status'], response['headers'], None
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def __getattr__(name):
+    # asgi:application is built on first use, like app:APP
+    global application
+    if name == 'application':
+        application = AsgiApp(get_app())
+        return application
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
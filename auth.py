@@ -1,14 +1,66 @@
-import json
-from flask import request, _request_ctx_stack
+import os
+from flask import g, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jwks import JWKSCache, key_source
+from token_cache import TokenCache
+from instrumentation import timed
 
 
 AUTH0_DOMAIN = 'fsndcoffee.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'musicstore'
 
+# tokens are verified against this issuer, audience and key source: a
+# JWKS url, or a local JWKS or PEM file that is reloaded when it changes
+AUTH_ISSUER = os.environ.get('AUTH_ISSUER', f'https://{AUTH0_DOMAIN}/')
+AUTH_AUDIENCE = os.environ.get('AUTH_AUDIENCE', API_AUDIENCE)
+AUTH_KEYS = os.environ.get(
+    'AUTH_KEYS', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# signing keys are cached in process and refreshed before they expire
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_REFETCH_INTERVAL = int(os.environ.get('JWKS_REFETCH_INTERVAL', 30))
+
+# verified payloads are cached by token hash until the token expires
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE)
+
+jwks_cache = JWKSCache(
+    key_source(AUTH_KEYS),
+    ttl=JWKS_CACHE_TTL,
+    min_refetch_interval=JWKS_REFETCH_INTERVAL,
+    on_rotate=token_cache.purge
+)
+
+
+# error bodies are built once, handlers only serialize them
+HEADER_MISSING = {
+    'code': 'authorization_header_missing',
+    'description': 'Authorization header is expected.'
+}
+HEADER_NOT_BEARER = {
+    'code': 'invalid_header',
+    'description': 'Authorization header must start with "Bearer".'
+}
+TOKEN_MISSING = {
+    'code': 'invalid_header',
+    'description': 'Token not found.'
+}
+HEADER_TOO_LONG = {
+    'code': 'invalid_header',
+    'description': 'Authorization header must be bearer token.'
+}
+PERMISSIONS_MISSING = {
+    'code': 'invalid_claims',
+    'description': 'Permissions not included in JWT.'
+}
+PERMISSION_NOT_FOUND = {
+    'code': 'unauthorized',
+    'description': 'Permission not found.'
+}
+
 
 class AuthError(Exception):
     """AuthError Exception
@@ -20,6 +72,28 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class Claims(dict):
+    """Claims
+    A verified token payload. Its permissions are frozen into a set once,
+    and cached with the token, so every check is a set lookup.
+    """
+
+    def __init__(self, payload):
+        super().__init__(payload)
+        permissions = payload.get('permissions', None)
+        self.granted = frozenset(permissions) \
+            if permissions is not None else None
+
+
+def accepted_scopes(permission):
+    '''
+    Returns the scopes that grant permission: itself and the wildcard
+    of its action, e.g. get:albums and get:*
+    '''
+    action, _, resource = permission.partition(':')
+    return (permission, f'{action}:*') if resource else (permission,)
+
+
 # Auth Header
 def get_token_auth_header():
     """
@@ -29,61 +103,47 @@ def get_token_auth_header():
     # get auth from header and verify auth exists
     auth = request.headers.get('Authorization', None)
     if not auth:
-        raise AuthError({
-            'code': 'authorization_header_missing',
-            'description': 'Authorization header is expected.'
-        }, 401)
+        raise AuthError(HEADER_MISSING, 401)
 
     # split keyword and token
     parts = auth.split()
 
     # verify keyword is 'bearer', raise error if not
     if parts[0].lower() != 'bearer':
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must start with "Bearer".'
-        }, 401)
+        raise AuthError(HEADER_NOT_BEARER, 401)
 
     # auth header must have 2 parts
     elif len(parts) == 1:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Token not found.'
-        }, 401)
+        raise AuthError(TOKEN_MISSING, 401)
 
     # auth header must have 2 parts
     elif len(parts) > 2:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must be bearer token.'
-        }, 401)
+        raise AuthError(HEADER_TOO_LONG, 401)
 
     # get token from parts and return
     token = parts[1]
     return token
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, scopes=None):
     """
-    Ensures that permission exists in payload
+    Ensures that permission, or a wildcard granting it, exists in payload
     """
 
-    # Ensures that there is permissions field in the payload
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+    # verified payloads carry their permissions as a set already
+    granted = getattr(payload, 'granted', None)
+    if granted is None:
+        # Ensures that there is permissions field in the payload
+        if 'permissions' not in payload:
+            raise AuthError(PERMISSIONS_MISSING, 400)
+        granted = frozenset(payload['permissions'])
 
     # Ensures that the specific permission exists
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 401)
+    for scope in scopes or accepted_scopes(permission):
+        if scope in granted:
+            return True
 
-    # if conditions pass return true
-    return True
+    raise AuthError(PERMISSION_NOT_FOUND, 401)
 
 
 def verify_decode_jwt(token):
@@ -91,12 +151,18 @@ def verify_decode_jwt(token):
     Verifies and decodes the jwt from the given token
     '''
 
-    # process key and header data
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
+    # a refresh that drops a key purges the tokens it signed, so it has
+    # to run before the token cache is read
+    with timed('jwks'):
+        jwks_cache.check()
 
-    rsa_key = {}
+    # tokens that were already verified skip signature verification
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    # process header data
+    unverified_header = jwt.get_unverified_header(token)
 
     # Ensure that token header has the kid field
     if 'kid' not in unverified_header:
@@ -105,26 +171,22 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # look up the signing key in the in-process key cache
+    with timed('jwks'):
+        rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             # decode the token using defined constants
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timed('jwt'):
+                payload = Claims(jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=AUTH_AUDIENCE,
+                    issuer=AUTH_ISSUER
+                ))
 
+            token_cache.set(token, payload, kid=rsa_key['kid'])
             return payload
 
         # raise errors for common exceptions
@@ -155,13 +217,41 @@ def requires_auth(permission=''):
     '''
     authhentication decorator function
     '''
+    scopes = accepted_scopes(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            # metrics are labelled with the route's permission
+            g.permission = permission
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload, scopes)
             return f(payload, *args, **kwargs)
 
+        # read by route_scopes, wraps copies it to outer decorators
+        wrapper.permission = permission
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
+
+
+def route_scopes(app):
+    '''
+    Returns every route of app with the permission its requires_auth
+    asks for, None for public routes. Built once per app.
+    '''
+    scopes = app.extensions.get('route_scopes')
+    if scopes is None:
+        scopes = app.extensions['route_scopes'] = sorted([
+            {
+                'rule': rule.rule,
+                'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'}),
+                'endpoint': rule.endpoint,
+                'permission': getattr(
+                    app.view_functions[rule.endpoint], 'permission', None)
+            }
+            for rule in app.url_map.iter_rules()
+            if rule.endpoint != 'static'
+        ], key=lambda route: (route['rule'], route['methods']))
+    return scopes
\ No newline at end of file
@@ -0,0 +1,108 @@
+'''
+Local stand-in for the Auth0 tenant: signs RS256 tokens and serves the
+matching JWKS over HTTP or writes it to a key file, so the API can be
+exercised offline.
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jwks import rsa_jwk
+
+ALL_PERMISSIONS = [
+    'get:albums', 'get:artists', 'post:albums', 'post:artists',
+    'patch:albums', 'patch:artists', 'delete:albums', 'delete:artists',
+    'get:metrics', 'get:scopes'
+]
+
+# the permissions of the Auth0 roles
+ROLES = {
+    'customer': ['get:albums', 'get:artists'],
+    'manager': ALL_PERMISSIONS
+}
+
+
+class LocalIssuer:
+    """LocalIssuer
+    Holds an RSA key pair, mints tokens for issuer/audience and serves
+    the public key at http://127.0.0.1:<port>/.well-known/jwks.json
+    or writes it as a JWKS or PEM file for AUTH_KEYS. Without a kid the
+    key's thumbprint is used, which is also the kid of PEM keys.
+    """
+
+    def __init__(self, issuer, audience, kid=None, bits=2048,
+                 private_pem=None):
+        self.issuer = issuer
+        self.audience = audience
+        self.key = RSA.import_key(private_pem) if private_pem \
+            else RSA.generate(bits)
+        self.private_pem = self.key.exportKey('PEM').decode('ascii')
+        self.kid = kid or rsa_jwk(self.key)['kid']
+        self.server = None
+
+    @property
+    def jwks(self):
+        return {'keys': [rsa_jwk(self.key, self.kid)]}
+
+    @property
+    def public_pem(self):
+        return self.key.publickey().exportKey('PEM').decode('ascii')
+
+    @property
+    def jwks_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def write_keys(self, path, fmt='jwks'):
+        '''
+        Writes the public key to path as a JWKS document or PEM
+        '''
+        with open(path, 'w') as keys_file:
+            if fmt == 'pem':
+                keys_file.write(self.public_pem + '\n')
+            else:
+                json.dump(self.jwks, keys_file)
+
+    def token(self, permissions=ALL_PERMISSIONS, expires_in=3600,
+              subject='bench|local'):
+        now = int(time.time())
+        claims = {
+            'iss': self.issuer,
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def start(self, host='127.0.0.1', port=0):
+        body = json.dumps(self.jwks).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/.well-known/jwks.json':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
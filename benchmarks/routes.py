@@ -0,0 +1,312 @@
+'''
+Drives every route of the API against a seeded database and prints one
+JSON line per route with throughput, latency percentiles and SQL query
+counts, so runs can be compared across commits.
+
+Tokens are signed by a local issuer stand-in, nothing leaves the machine.
+
+    python -m benchmarks.routes --rows 10000 100000 --concurrency 8
+'''
+import argparse
+import http.client
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_migrate import Migrate, upgrade
+from werkzeug.serving import WSGIRequestHandler, make_server
+import auth
+from app import create_app
+from jwks import url_fetcher
+from models import db, Album, Artist
+from stats import rebuild_stats
+from benchmarks.issuer import LocalIssuer
+
+# the benchmark uses its own database unless DATABASE_URL is set
+BENCH_DATABASE_URL = 'sqlite:////tmp/music-store-bench.db'
+
+SEED_CHUNK_SIZE = 10000
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'migrations')
+
+QUERIES = re.compile(r'db;dur=[0-9.]+;desc="(\d+) queries"')
+
+
+def seed(rows):
+    '''
+    Replaces the catalogue with rows synthetic albums by rows / 10 artists
+    '''
+    if Album.query.count() == rows:
+        return
+
+    artists = max(1, rows // 10)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            'TRUNCATE albums, artists RESTART IDENTITY CASCADE')
+    else:
+        db.session.execute(Album.__table__.delete())
+        db.session.execute(Artist.__table__.delete())
+
+    for start in range(0, artists, SEED_CHUNK_SIZE):
+        db.session.execute(Artist.__table__.insert(), [
+            {'name': f'Artist {i}', 'version': 1}
+            for i in range(start, min(start + SEED_CHUNK_SIZE, artists))
+        ])
+    artist_ids = [id for id, in db.session.query(Artist.id)
+                  .order_by(Artist.id)]
+
+    for start in range(0, rows, SEED_CHUNK_SIZE):
+        db.session.execute(Album.__table__.insert(), [
+            {'title': f'Album {i}', 'year': 1950 + i % 75,
+             'artist': f'Artist {i % artists}',
+             'artist_id': artist_ids[i % artists], 'version': 1}
+            for i in range(start, min(start + SEED_CHUNK_SIZE, rows))
+        ])
+    db.session.commit()
+    rebuild_stats()
+
+
+class Scenario:
+    """Scenario
+    One route, request(i) returns (method, path, body) for request i.
+    Scenarios creating rows hand their ids to the ones deleting them.
+    """
+
+    def __init__(self, name, method, path, body=None, created=None,
+                 deletes=None, max_requests=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.created = created
+        self.deletes = deletes
+        self.max_requests = max_requests
+
+    def request(self, i):
+        if self.deletes is not None:
+            path = self.path(self.deletes.pop())
+        else:
+            path = self.path(i)
+        body = self.body(i) if self.body else None
+        return self.method, path, body
+
+    def response(self, body):
+        if self.created is not None:
+            self.created.append(body[self.created.key]['id'])
+
+
+class Created(list):
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+
+
+def scenarios(rows, run):
+    artists = max(1, rows // 10)
+    album = lambda i: 1 + (i * 7919) % rows  # noqa: E731
+    artist = lambda i: 1 + (i * 7919) % artists  # noqa: E731
+    albums, artist_rows = Created('album'), Created('artist')
+
+    return [
+        Scenario('GET /albums', 'GET', lambda i: '/albums?limit=100'),
+        Scenario('GET /albums?fields', 'GET',
+                 lambda i: '/albums?limit=100&fields=title'),
+        Scenario('GET /albums?artist&sort', 'GET',
+                 lambda i: f'/albums?artist=Artist%20{artist(i) - 1}'
+                 '&sort=-year,title&limit=100'),
+        Scenario('GET /albums?year&sort', 'GET',
+                 lambda i: f'/albums?year_from={1950 + i % 70}'
+                 f'&year_to={1955 + i % 70}&sort=year&limit=100'),
+        Scenario('GET /albums/counts', 'GET',
+                 lambda i: '/albums/counts?by=' + ('year', 'artist')[i % 2]),
+        Scenario('GET /stats', 'GET', lambda i: '/stats'),
+        Scenario('GET /albums/<id>', 'GET',
+                 lambda i: f'/albums/{album(i)}'),
+        Scenario('GET /albums/export', 'GET', lambda i: '/albums/export',
+                 max_requests=5),
+        Scenario('GET /artists', 'GET', lambda i: '/artists?limit=100'),
+        Scenario('GET /artists?embed=albums', 'GET',
+                 lambda i: '/artists?limit=50&embed=albums'),
+        Scenario('GET /artists/<id>', 'GET',
+                 lambda i: f'/artists/{artist(i)}'),
+        Scenario('GET /artists/<id>/albums', 'GET',
+                 lambda i: f'/artists/{artist(i)}/albums'),
+        Scenario('GET /search', 'GET',
+                 lambda i: f'/search?q=Artist%20{i % 1000}&limit=20'),
+        Scenario('POST /albums', 'POST', lambda i: '/albums',
+                 lambda i: {'title': f'Bench {run} {i}', 'year': 2000,
+                            'artist': 'Artist 1'}, created=albums),
+        Scenario('PATCH /albums/<id>', 'PATCH',
+                 lambda i: f'/albums/{album(i)}',
+                 lambda i: {'year': 1950 + i % 75}),
+        Scenario('DELETE /albums/<id>', 'DELETE', lambda id: f'/albums/{id}',
+                 deletes=albums),
+        Scenario('POST /artists', 'POST', lambda i: '/artists',
+                 lambda i: {'name': f'Bench {run} {i}'}, created=artist_rows),
+        Scenario('PATCH /artists/<id>', 'PATCH',
+                 lambda i: f'/artists/{artist(i)}',
+                 lambda i: {'name': f'Artist {artist(i) - 1}'}),
+        Scenario('DELETE /artists/<id>', 'DELETE',
+                 lambda id: f'/artists/{id}', deletes=artist_rows),
+        Scenario('POST /albums/bulk', 'POST', lambda i: '/albums/bulk',
+                 lambda i: [{'title': f'Bulk {run} {i} {n}', 'year': 2000,
+                             'artist': 'Artist 1'} for n in range(100)])
+    ]
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+def milliseconds(seconds):
+    # None for scenarios that sent no requests, e.g. nothing to delete
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def drive(address, token, scenario, requests, concurrency):
+    '''
+    Sends requests to one route from concurrency threads
+    '''
+    if scenario.max_requests is not None:
+        requests = min(requests, scenario.max_requests)
+    if scenario.deletes is not None:
+        requests = min(requests, len(scenario.deletes))
+
+    latencies, queries, errors, hits = [], [], [], []
+    lock = threading.Lock()
+
+    def send(i):
+        with lock:
+            method, path, body = scenario.request(i)
+        headers = {'Authorization': f'Bearer {token}'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        connection = http.client.HTTPConnection(*address)
+        started = time.perf_counter()
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        data = response.read()
+        elapsed = time.perf_counter() - started
+        connection.close()
+
+        match = QUERIES.search(response.getheader('Server-Timing', ''))
+        with lock:
+            latencies.append(elapsed)
+            if match:
+                queries.append(int(match.group(1)))
+            if response.status >= 400:
+                errors.append(response.status)
+            elif method == 'POST':
+                scenario.response(json.loads(data))
+            if response.getheader('X-Cache') == 'HIT':
+                hits.append(i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    duration = time.perf_counter() - started
+
+    return {
+        'route': scenario.name,
+        'requests': requests,
+        'errors': len(errors),
+        'throughput_rps': round(requests / duration, 1)
+        if requests and duration else None,
+        'p50_ms': milliseconds(percentile(latencies, 0.5)),
+        'p95_ms': milliseconds(percentile(latencies, 0.95)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'queries_per_request': round(sum(queries) / len(queries), 2)
+        if queries else None,
+        'cache_hits': len(hits)
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--routes', nargs='*',
+                        help='only run routes whose name contains one of '
+                        'these strings')
+    parser.add_argument('--output', help='append results to this file')
+    args = parser.parse_args()
+
+    issuer = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE).start()
+    auth.jwks_cache.fetcher = url_fetcher(issuer.jwks_url)
+    auth.jwks_cache.clear()
+    auth.jwks_cache.refresh()
+    token = issuer.token()
+
+    os.environ.setdefault('DATABASE_URL', BENCH_DATABASE_URL)
+    os.environ.setdefault('FLASK_ENV', 'development')
+    app = create_app()
+    Migrate(app, db)
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = ('127.0.0.1', server.server_port)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    database = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+    revision = commit()
+    run = int(time.time())
+    try:
+        for rows in args.rows:
+            with app.app_context():
+                seed(rows)
+                db.session.remove()
+
+            for scenario in scenarios(rows, run):
+                if args.routes and not any(
+                        name in scenario.name for name in args.routes):
+                    continue
+                result = drive(address, token, scenario, args.requests,
+                               args.concurrency)
+                result.update({
+                    'rows': rows,
+                    'concurrency': args.concurrency,
+                    'database': database,
+                    'commit': revision
+                })
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    finally:
+        server.shutdown()
+        issuer.stop()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Times GET /search queries in process against a seeded database, the
+typeahead prefixes a client sends while typing as well as whole words,
+and reports whether they stay within the 10 ms target.
+
+    python -m benchmarks.search --rows 100000 1000000
+'''
+import argparse
+import json
+import os
+import time
+
+from flask_migrate import Migrate, upgrade
+from app import create_app
+from models import db
+from search import search_catalogue, tokenize
+from benchmarks.routes import BENCH_DATABASE_URL, MIGRATIONS, commit, \
+    percentile, milliseconds, seed
+
+SEARCH_TARGET_MS = 10
+
+# prefixes typed one key at a time, then whole words
+QUERIES = ['a', 'al', 'alb', 'album 12', 'artist 4', 'artist 42 album',
+           'album 123456']
+
+
+def measure(query, repeat, years=None):
+    tokens = tokenize(query)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        search_catalogue(tokens, prefix=True, years=years)
+        timings.append(time.perf_counter() - started)
+        db.session.remove()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DATABASE_URL', BENCH_DATABASE_URL)
+    os.environ.setdefault('FLASK_ENV', 'development')
+    app = create_app()
+    Migrate(app, db)
+    database = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+    revision = commit()
+
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+        for rows in args.rows:
+            seed(rows)
+            db.session.remove()
+            for query in QUERIES:
+                for years in (None, {'year_from': 1980, 'year_to': 1990}):
+                    # one untimed run fills the caches
+                    timings = measure(query, args.repeat + 1, years)[1:]
+                    p95 = percentile(timings, 0.95)
+                    print(json.dumps({
+                        'query': query,
+                        'years': bool(years),
+                        'p50_ms': milliseconds(percentile(timings, 0.5)),
+                        'p95_ms': milliseconds(p95),
+                        'p99_ms': milliseconds(percentile(timings, 0.99)),
+                        'within_target': p95 * 1000 < SEARCH_TARGET_MS,
+                        'rows': rows,
+                        'database': database,
+                        'commit': revision
+                    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Compares building the GET /albums payload from ORM objects with format()
+and jsonify against tuple rows and the configured fast JSON backend.
+
+    python -m benchmarks.serialization --rows 10000 100000
+'''
+import argparse
+import json
+import statistics
+import time
+from flask import Flask, jsonify
+from models import setup_db, db, Album
+from pagination import keyset_page
+from serialization import JSON_BACKEND, json_response
+
+
+def seed(rows):
+    db.session.execute(Album.__table__.delete())
+    db.session.execute(Album.__table__.insert(), [
+        {'title': f'Album {i}', 'year': 1950 + i % 70,
+         'artist': f'Artist {i % 1000}', 'version': 1}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+
+def orm_jsonify():
+    albums = [album.format() for album in Album.query.order_by(Album.id)]
+    return jsonify({'success': True, 'albums': albums}).get_data()
+
+
+def tuple_json_response():
+    albums, _ = keyset_page(Album, list(Album.public_fields))
+    return json_response({'success': True, 'albums': albums}).get_data()
+
+
+def measure(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+    results = []
+    with app.test_request_context():
+        db.create_all()
+        for rows in args.rows:
+            seed(rows)
+            baseline = measure(orm_jsonify, args.repeat)
+            fast = measure(tuple_json_response, args.repeat)
+            results.append({
+                'rows': rows,
+                'backend': JSON_BACKEND,
+                'orm_jsonify_ms': round(baseline * 1000, 2),
+                'tuple_json_ms': round(fast * 1000, 2),
+                'speedup': round(baseline / fast, 2)
+            })
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+from flask import abort
+from sqlalchemy import func
+from sqlalchemy.exc import DataError, IntegrityError
+from models import db, Album, Artist, CatalogueStat
+
+# rows written per transaction
+BULK_CHUNK_SIZE = 1000
+
+# upper bound for the number of items in one request
+BULK_MAX_ITEMS = 50000
+
+BULK_SPECS = {
+    Album: {
+        'key': 'album',
+        'required': ('title', 'year', 'artist'),
+        'fields': ('title', 'year', 'artist', 'artist_id'),
+        'unique': ('title',)
+    },
+    Artist: {
+        'key': 'artist',
+        'required': ('name',),
+        'fields': ('name',),
+        'unique': ()
+    }
+}
+
+
+def get_bulk_items(data):
+    '''
+    Validates the body of a bulk request, 400 unless it is a list
+    '''
+    if not isinstance(data, list) or not data or len(data) > BULK_MAX_ITEMS:
+        abort(400)
+    return data
+
+
+def _column_value(column, value):
+    '''
+    Converts a value to the type of its column like the database would,
+    ValueError if it does not fit, e.g. a year of 'abc'
+    '''
+    if value is None:
+        if column.nullable:
+            return None
+        raise ValueError(column.name)
+
+    python_type = column.type.python_type
+    if python_type is int and isinstance(value, str):
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, python_type):
+        raise ValueError(column.name)
+
+    if python_type is int and not -2 ** 31 <= value < 2 ** 31:
+        raise ValueError(column.name)
+    length = getattr(column.type, 'length', None)
+    if length is not None and len(value) > length:
+        raise ValueError(column.name)
+    return value
+
+
+def _mapping(model, item, fields):
+    '''
+    Returns the fields present in an item converted to their column
+    types, None if the item is not an object or a value does not fit,
+    so a bad row is answered 400 before its chunk is written
+    '''
+    if not isinstance(item, dict):
+        return None
+    try:
+        return {field: _column_value(model.__table__.c[field], item[field])
+                for field in fields if field in item}
+    except ValueError:
+        return None
+
+
+def _result(index, status, message=None, **data):
+    result = {'index': index, 'status': status}
+    if message is not None:
+        result['message'] = message
+    result.update(data)
+    return result
+
+
+def _chunks(items):
+    for start in range(0, len(items), BULK_CHUNK_SIZE):
+        yield list(enumerate(items[start:start + BULK_CHUNK_SIZE], start))
+
+
+def _link_artists(rows):
+    '''
+    Resolves artist_id for album rows with one query per chunk
+    '''
+    names = {mapping['artist'] for _, mapping in rows
+             if 'artist' in mapping and mapping.get('artist_id') is None}
+    if not names:
+        return
+
+    artist_ids = dict(
+        db.session.query(Artist.name, func.min(Artist.id))
+        .filter(Artist.name.in_(names))
+        .group_by(Artist.name)
+    )
+    for _, mapping in rows:
+        if mapping.get('artist') in names and mapping.get('artist_id') is None:
+            mapping['artist_id'] = artist_ids.get(mapping['artist'])
+
+
+def _drop_conflicts(model, rows, results):
+    '''
+    Marks rows that would break a unique constraint as 409 and
+    returns the remaining rows
+    '''
+    for field in BULK_SPECS[model]['unique']:
+        column = getattr(model, field)
+        values = {mapping[field] for _, mapping in rows if field in mapping}
+        if not values:
+            continue
+
+        taken = dict(
+            db.session.query(column, model.id).filter(column.in_(values)))
+        seen = set()
+        remaining = []
+        for index, mapping in rows:
+            value = mapping.get(field)
+            if value is not None and (
+                    value in seen or
+                    taken.get(value, mapping.get('id')) != mapping.get('id')):
+                results[index] = _result(index, 409, 'conflict', field=field)
+                continue
+            seen.add(value)
+            remaining.append((index, mapping))
+        rows = remaining
+    return rows
+
+
+def _write(write, model, rows, results):
+    '''
+    Writes a chunk in one transaction. If the chunk fails, every row is
+    retried in its own savepoint so one bad row does not sink the others.
+    '''
+    try:
+        write(model, [mapping for _, mapping in rows])
+        db.session.commit()
+        return [index for index, _ in rows]
+    except (IntegrityError, DataError):
+        db.session.rollback()
+
+    written = []
+    for index, mapping in rows:
+        try:
+            with db.session.begin_nested():
+                write(model, [mapping])
+            written.append(index)
+        except IntegrityError:
+            results[index] = _result(index, 409, 'conflict')
+        except DataError:
+            results[index] = _result(index, 400, 'bad request')
+    db.session.commit()
+    return written
+
+
+def _album_updates(mappings):
+    '''
+    Returns the catalogue statistics deltas of album updates, from the
+    artist and year the rows have before them. The rows stay locked
+    until the commit, so the deltas are applied after the update.
+    '''
+    changed = {mapping['id']: mapping for mapping in mappings
+               if 'artist' in mapping or 'year' in mapping}
+    if not changed:
+        return {}
+
+    added, removed = [], []
+    for row_id, artist, year in db.session.query(
+            Album.id, Album.artist, Album.year).filter(
+            Album.id.in_(list(changed))).order_by(Album.id) \
+            .with_for_update():
+        mapping = changed[row_id]
+        removed.append((artist, year))
+        added.append((mapping.get('artist', artist), mapping.get('year', year)))
+    return CatalogueStat.album_deltas(added, removed)
+
+
+def _inserted_ids(model, mappings):
+    '''
+    Reads back the ids of rows inserted with executemany: by their unique
+    column, or as the newest ids of the table, the rows got consecutive
+    ids since SQLite holds the write lock until the commit
+    '''
+    unique = BULK_SPECS[model]['unique']
+    if unique:
+        column = getattr(model, unique[0])
+        ids = dict(db.session.query(column, model.id).filter(column.in_(
+            [mapping[unique[0]] for mapping in mappings])))
+        return [ids[mapping[unique[0]]] for mapping in mappings]
+
+    last = db.session.query(func.max(model.id)).scalar()
+    return list(range(last - len(mappings) + 1, last + 1))
+
+
+# statistics are written with the rows so a rolled back chunk or
+# savepoint takes its deltas with it. Album rows are written before the
+# statistics and before artist rows, the order single writes use.
+def _insert(model, mappings):
+    '''
+    Inserts a chunk with one statement and sets the new ids on the
+    mappings. PostgreSQL inserts all rows with one INSERT ... VALUES and
+    RETURNING, which returns the ids in the order of the VALUES, other
+    backends use one executemany and a SELECT of the new ids.
+    '''
+    table = model.__table__
+    # every row needs the same keys for one statement
+    values = [{field: mapping.get(field) for field in
+               BULK_SPECS[model]['fields']} for mapping in mappings]
+    if model is Artist:
+        Album.lock(Album.artist.in_(
+            {mapping['name'] for mapping in mappings}))
+    if db.engine.dialect.name == 'postgresql':
+        ids = [row_id for row_id, in db.session.execute(
+            table.insert().values(values).returning(table.c.id))]
+    else:
+        db.session.execute(table.insert(), values)
+        ids = _inserted_ids(model, mappings)
+    for mapping, row_id in zip(mappings, ids):
+        mapping['id'] = row_id
+
+    if model is Album:
+        CatalogueStat.apply(CatalogueStat.album_deltas(added=[
+            (mapping['artist'], mapping['year']) for mapping in mappings]))
+    else:
+        Album.link_artists({mapping['name'] for mapping in mappings})
+
+
+def _update(model, mappings):
+    if model is Album:
+        deltas = _album_updates(mappings)
+    else:
+        names = {mapping['name'] for mapping in mappings
+                 if 'name' in mapping}
+        if names:
+            Album.lock(Album.artist.in_(names))
+    db.session.bulk_update_mappings(model, mappings)
+    if model is Album:
+        CatalogueStat.apply(deltas)
+    else:
+        Album.link_artists(names)
+
+
+def bulk_create(model, items):
+    '''
+    Inserts items in chunks, returns one result per item
+    '''
+    spec = BULK_SPECS[model]
+    results = [None] * len(items)
+
+    for chunk in _chunks(items):
+        rows = []
+        for index, item in chunk:
+            mapping = _mapping(model, item, spec['fields'])
+            if mapping is None or \
+                    any(field not in mapping for field in spec['required']):
+                results[index] = _result(index, 400, 'bad request')
+                continue
+            rows.append((index, mapping))
+
+        rows = _drop_conflicts(model, rows, results)
+        if model is Album:
+            _link_artists(rows)
+        if not rows:
+            continue
+
+        mappings = dict(rows)
+        for index in _write(_insert, model, rows, results):
+            formatted = {field: mappings[index].get(field)
+                         for field in model.public_fields}
+            results[index] = _result(index, 201, **{spec['key']: formatted})
+
+    return results
+
+
+def bulk_update(model, items):
+    '''
+    Updates items by id in chunks, returns one result per item
+    '''
+    spec = BULK_SPECS[model]
+    results = [None] * len(items)
+
+    for chunk in _chunks(items):
+        rows = []
+        for index, item in chunk:
+            mapping = _mapping(model, item, spec['fields'])
+            if mapping is None or not isinstance(item.get('id'), int):
+                results[index] = _result(index, 400, 'bad request')
+                continue
+            mapping['id'] = item['id']
+            rows.append((index, mapping))
+
+        ids = [mapping['id'] for _, mapping in rows]
+        existing = {row_id for row_id, in
+                    db.session.query(model.id).filter(model.id.in_(ids))} \
+            if ids else set()
+        found = []
+        for index, mapping in rows:
+            if mapping['id'] in existing:
+                found.append((index, mapping))
+            else:
+                results[index] = _result(index, 404, 'resource not found')
+
+        rows = _drop_conflicts(model, found, results)
+        if model is Album:
+            _link_artists(rows)
+        if not rows:
+            continue
+
+        ids_by_index = {index: mapping['id'] for index, mapping in rows}
+        written = _write(_update, model, rows, results)
+        updated = {row.id: row for row in
+                   model.query.filter(model.id.in_(
+                       [ids_by_index[index] for index in written]))} \
+            if written else {}
+        for index in written:
+            row = updated[ids_by_index[index]]
+            results[index] = _result(index, 200, **{spec['key']: row.format()})
+
+    return results
+
+
+def bulk_delete(model, ids):
+    '''
+    Deletes rows by id in chunks, returns one result per id
+    '''
+    results = [None] * len(ids)
+
+    for chunk in _chunks(ids):
+        valid = []
+        for index, row_id in chunk:
+            if isinstance(row_id, int):
+                valid.append((index, row_id))
+            else:
+                results[index] = _result(index, 400, 'bad request')
+
+        chunk_ids = [row_id for _, row_id in valid]
+        existing = {row_id for row_id, in
+                    db.session.query(model.id)
+                    .filter(model.id.in_(chunk_ids))} \
+            if chunk_ids else set()
+
+        if existing:
+            if model is Artist:
+                Album.lock(Album.artist_id.in_(existing))
+                Album.query.filter(Album.artist_id.in_(existing)) \
+                    .update({Album.artist_id: None},
+                            synchronize_session=False)
+            else:
+                removed = db.session.query(Album.artist, Album.year) \
+                    .filter(Album.id.in_(existing)).order_by(Album.id) \
+                    .with_for_update().all()
+            model.query.filter(model.id.in_(existing)) \
+                .delete(synchronize_session=False)
+            if model is Album:
+                CatalogueStat.apply(
+                    CatalogueStat.album_deltas(removed=removed))
+            db.session.commit()
+
+        for index, row_id in valid:
+            if row_id in existing:
+                existing.discard(row_id)
+                results[index] = _result(index, 200, deleted=row_id)
+            else:
+                results[index] = _result(index, 404, 'resource not found')
+
+    return results
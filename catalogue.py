@@ -0,0 +1,91 @@
+from flask import abort
+from sqlalchemy import func
+from models import db, Album
+
+# ?by= of the album counts and the column each one groups by
+ALBUM_GROUPS = {
+    'year': Album.year,
+    'artist': Album.artist
+}
+
+
+def get_album_filters(args):
+    '''
+    Reads artist, year_from and year_to from the query string and returns
+    them as filter criteria for albums
+    '''
+    criteria = []
+    artist = args.get('artist', None)
+    if artist is not None:
+        criteria.append(Album.artist == artist)
+
+    try:
+        year_from = int(args['year_from']) if args.get('year_from') else None
+        year_to = int(args['year_to']) if args.get('year_to') else None
+    except ValueError:
+        abort(400)
+
+    if year_from is not None and year_to is not None and year_from > year_to:
+        abort(400)
+    if year_from is not None:
+        criteria.append(Album.year >= year_from)
+    if year_to is not None:
+        criteria.append(Album.year <= year_to)
+    return criteria
+
+
+def get_group(args):
+    by = args.get('by', None)
+    if by not in ALBUM_GROUPS:
+        abort(400)
+    return by
+
+
+def count_query(by, criteria=()):
+    '''
+    Counts the albums matching criteria per year or per artist, grouped
+    in SQL so no album rows are loaded
+    '''
+    column = ALBUM_GROUPS[by]
+    return db.session.query(column, func.count()) \
+        .filter(*criteria) \
+        .group_by(column) \
+        .order_by(column)
+
+
+def album_counts(by, criteria=()):
+    return [{by: key, 'albums': count}
+            for key, count in count_query(by, criteria)]
+
+
+def explain(query):
+    '''
+    Returns the query plan of a Query as a list of lines.
+    On PostgreSQL sequential scans are disabled while planning, so a
+    'Seq Scan' in the plan means no index can serve the query at all,
+    not that the table is too small to bother.
+    '''
+    statement = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        rows = db.session.execute(f'EXPLAIN {statement}')
+        plan = [row[0] for row in rows]
+        db.session.rollback()
+    elif dialect == 'sqlite':
+        rows = db.session.execute(f'EXPLAIN QUERY PLAN {statement}')
+        plan = [row[-1] for row in rows]
+    else:
+        abort(500)
+    return plan
+
+
+def sequential_scans(plan):
+    '''
+    Returns the steps of a plan from explain that read a whole table
+    '''
+    return [step for step in plan
+            if 'Seq Scan' in step or
+            (step.startswith('SCAN') and ' USING ' not in step)]
@@ -0,0 +1,124 @@
+import os
+import zlib
+from flask import request
+from response_cache import LRUBackend
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt, gzip alone works without it
+    brotli = None
+
+# responses smaller than this are sent as they are
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+# compressed bodies kept by ETag and encoding
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', 256))
+COMPRESS_CACHE_TTL = int(os.environ.get('COMPRESS_CACHE_TTL', 300))
+
+COMPRESS_MIMETYPES = (
+    'application/json',
+    'application/x-ndjson',
+    'application/msgpack',
+    'application/vnd.apache.arrow.stream'
+)
+
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip']
+
+
+def preferred_encoding():
+    '''
+    Returns the content coding for the request's Accept-Encoding header,
+    None for identity
+    '''
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+class Compression:
+    """Compression
+    Compresses responses with gzip or brotli as negotiated through
+    Accept-Encoding. Streamed responses are compressed chunk by chunk
+    and flushed after each one, buffered responses with an ETag are
+    compressed once and reused.
+    """
+
+    def __init__(self, app=None, min_size=COMPRESS_MIN_SIZE,
+                 level=COMPRESS_LEVEL, brotli_quality=BROTLI_QUALITY,
+                 cache_size=COMPRESS_CACHE_SIZE, cache_ttl=COMPRESS_CACHE_TTL):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.cache = LRUBackend(maxsize=cache_size)
+        self.cache_ttl = cache_ttl
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.compress_response)
+
+    def compressor(self, encoding):
+        '''
+        Returns (compress, flush, finish) functions for encoding
+        '''
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process, compressor.flush, compressor.finish
+
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return (compressor.compress,
+                lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                compressor.flush)
+
+    def compress(self, data, encoding):
+        compress, _, finish = self.compressor(encoding)
+        return compress(data) + finish()
+
+    def compress_stream(self, chunks, encoding):
+        compress, flush, finish = self.compressor(encoding)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    # flush so each chunk reaches the client right away
+                    yield compress(chunk) + flush()
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def compress_response(self, response):
+        if response.mimetype not in COMPRESS_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+
+        if response.status_code != 200 or response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+
+        encoding = preferred_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.compress_stream(
+                response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+
+            etag, _ = response.get_etag()
+            key = f'{request.path}|{etag}|{encoding}'
+            compressed = self.cache.get(key) if etag else None
+            if compressed is None:
+                compressed = self.compress(data, encoding)
+                if etag:
+                    self.cache.set(key, compressed, self.cache_ttl)
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,117 @@
+import hashlib
+from functools import wraps
+from flask import Response, make_response, request
+from sqlalchemy import func
+from models import db, TableChange
+from serialization import preferred_format
+from compression import preferred_encoding
+
+
+def make_etag(*parts):
+    '''
+    Builds a strong ETag from row state, the request's path and query
+    string and the negotiated media type and content coding
+    '''
+    raw = '|'.join(str(part) for part in parts + (
+        request.path, request.query_string, preferred_format(),
+        preferred_encoding()))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def row_etag(row):
+    return make_etag(row.__tablename__, row.id, row.version)
+
+
+def row_state(model, id):
+    '''
+    Returns the ETag and Last-Modified of one row, None if it is missing
+    '''
+    row = db.session.query(model.version, model.updated_at) \
+        .filter(model.id == id).one_or_none()
+    if row is None:
+        return None
+
+    version, updated_at = row
+    return make_etag(model.__tablename__, id, version), updated_at
+
+
+def collection_state(*models):
+    '''
+    Returns the ETag and Last-Modified of whole tables from their change
+    logs, read through the (name, id) index. Unlike a count and
+    max(updated_at) the log changes for every committed write, also one
+    whose timestamp is older than a write committed before it. Ids are
+    handed out before commit, so a transaction that started earlier but
+    commits later only shows in the number of rows.
+    '''
+    names = [model.__tablename__ for model in models]
+    changes = {
+        name: ((last, count), changed_at)
+        for name, last, count, changed_at in
+        db.session.query(TableChange.name, func.max(TableChange.id),
+                         func.count(TableChange.id),
+                         func.max(TableChange.changed_at))
+        .filter(TableChange.name.in_(names))
+        .group_by(TableChange.name)
+    }
+
+    parts = []
+    last_modified = None
+    for name in names:
+        marker, changed_at = changes.get(name, (None, None))
+        parts.extend((name, marker))
+        if changed_at is not None and \
+                (last_modified is None or changed_at > last_modified):
+            last_modified = changed_at
+
+    return make_etag(*parts), last_modified
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        # HTTP dates have a resolution of one second
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def matches_if_match(etag):
+    '''
+    True unless the request carries an If-Match that does not match etag
+    '''
+    if not request.if_match:
+        return True
+    return request.if_match.contains(etag) or request.if_match.star_tag
+
+
+def conditional(state):
+    '''
+    Answers GET requests with 304 when the client's copy is current.
+    state(**view_args) returns (etag, last_modified), or None to let
+    the view handle a missing row.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            current = state(**kwargs)
+            if current is None:
+                return f(*args, **kwargs)
+
+            etag, last_modified = current
+            if is_not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,101 @@
+from flask import Response, abort, stream_with_context
+from pagination import column_query, keyset_rows, sorted_query
+from instrumentation import timed
+from serialization import ARROW, dumps, pyarrow, arrow_schema, arrow_stream
+
+# rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json'
+}
+if pyarrow is not None:
+    EXPORT_FORMATS['arrow'] = ARROW
+
+
+def stream_ndjson(query, fields, batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Yields one row per line, a batch of lines per chunk
+    '''
+    lines = []
+    for row in query.yield_per(batch_size):
+        lines.append(dumps(dict(zip(fields, row))))
+        if len(lines) >= batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+def stream_json(query, fields, key, batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Yields the same payload shape as the list routes, one chunk per batch
+    '''
+    yield b'{"success": true, "%s": [' % key.encode('utf-8')
+
+    lines = []
+    first = True
+    for row in query.yield_per(batch_size):
+        lines.append(dumps(dict(zip(fields, row))))
+        if len(lines) >= batch_size:
+            yield (b'' if first else b',') + b','.join(lines)
+            first = False
+            lines = []
+
+    if lines:
+        yield (b'' if first else b',') + b','.join(lines)
+    yield b']}'
+
+
+def export_response(model, key, export_format):
+    '''
+    Returns a chunked response streaming the public fields of every row
+    of model, rows are read as tuples without ORM objects
+    '''
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    fields = model.public_fields
+    query = column_query(model, fields).order_by(model.id)
+    if export_format == 'ndjson':
+        rows = stream_ndjson(query, fields)
+    elif export_format == 'arrow':
+        rows = arrow_stream(
+            query.yield_per(EXPORT_BATCH_SIZE), arrow_schema(model, fields))
+    else:
+        rows = stream_json(query, fields, key)
+
+    return Response(
+        stream_with_context(rows),
+        mimetype=EXPORT_FORMATS[export_format]
+    )
+
+
+def arrow_page(model, fields, limit=None, after=None, criteria=(),
+               order=()):
+    '''
+    Returns a page of a list route as an Arrow IPC stream. Without a
+    limit the batches are streamed straight from the query, otherwise
+    the next cursor is sent in the X-Next-Cursor header.
+    '''
+    schema = arrow_schema(model, fields)
+    if limit is None:
+        # sort keys selected after fields are dropped by the schema
+        query, _ = sorted_query(model, fields, after, criteria, order)
+        response = Response(
+            stream_with_context(
+                arrow_stream(query.yield_per(EXPORT_BATCH_SIZE), schema)),
+            mimetype=ARROW)
+    else:
+        rows, next_cursor = keyset_rows(model, fields, limit, after,
+                                        criteria, order)
+        with timed('serialize'):
+            body = b''.join(arrow_stream(rows, schema))
+        response = Response(body, mimetype=ARROW)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+
+    response.vary.add('Accept')
+    return response
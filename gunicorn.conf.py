@@ -0,0 +1,31 @@
+# Read by gunicorn from the working directory: build the app once in the
+# master, then fork workers that only have to open their connections.
+import logging
+import sys
+from warmup import WARMUP
+
+preload_app = True
+
+# boot timings go to stderr next to gunicorn's own log
+boot_logger = logging.getLogger('music_store.boot')
+if not boot_logger.handlers:
+    boot_logger.setLevel(logging.INFO)
+    boot_logger.addHandler(logging.StreamHandler(sys.stderr))
+
+
+def when_ready(server):
+    # runs in the master once app:APP is loaded, before any fork
+    if WARMUP:
+        from app import get_app
+        from warmup import warm_up
+        warm_up(get_app(), connections=False, queries=False)
+
+
+def post_fork(server, worker):
+    from app import get_app
+    from warmup import reset_connections, warm_up
+
+    app = get_app()
+    reset_connections(app)
+    if WARMUP:
+        warm_up(app)
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, abort, make_response, request
+
+try:
+    import redis
+except ImportError:  # the shared store is optional
+    redis = None
+
+# completed requests are replayed for this many seconds
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_STORE_SIZE = int(os.environ.get('IDEMPOTENCY_STORE_SIZE', 10000))
+IDEMPOTENCY_URL = os.environ.get('IDEMPOTENCY_URL', None)
+
+# how long a duplicate waits for the request it duplicates
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))
+
+MAX_KEY_LENGTH = 255
+
+# headers that are recomputed for every response
+UNSTORED_HEADERS = ('Content-Length', 'Server-Timing')
+
+
+class Entry:
+    """Entry
+    A request seen with an Idempotency-Key, response is None until the
+    first request with that key finishes
+    """
+    __slots__ = ('fingerprint', 'expires_at', 'response', 'done')
+
+    def __init__(self, fingerprint, expires_at=None, response=None):
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+        self.response = response
+        self.done = threading.Event()
+
+
+class IdempotencyStore:
+    """IdempotencyStore
+    In-process store, entries expire after ttl seconds and the oldest
+    are dropped beyond maxsize.
+    """
+
+    def __init__(self, maxsize=IDEMPOTENCY_STORE_SIZE, ttl=IDEMPOTENCY_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, key, fingerprint):
+        '''
+        Returns (entry, True) if the caller is the first with key and
+        has to run the request, otherwise the existing entry and False
+        '''
+        with self._lock:
+            now = self.clock()
+            # entries share one ttl, so the oldest expire first
+            while self._entries and \
+                    next(iter(self._entries.values())).expires_at <= now:
+                self._entries.popitem(last=False)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+
+            entry = self._entries[key] = Entry(fingerprint, now + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return entry, True
+
+    def wait(self, key, entry, timeout):
+        return entry.done.wait(timeout)
+
+    def complete(self, key, entry, response):
+        entry.response = response
+        entry.done.set()
+
+    def fail(self, key, entry):
+        '''
+        Forgets a request that raised, so a retry runs it again
+        '''
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+
+class RedisIdempotencyStore:
+    """RedisIdempotencyStore
+    Shared store for all workers. The first request claims the key with
+    SET NX, duplicates poll until its response is stored.
+    """
+
+    def __init__(self, client, ttl=IDEMPOTENCY_TTL,
+                 prefix='music-store:idempotency:', poll_interval=0.05):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+
+    def _get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def begin(self, key, fingerprint):
+        claimed = self.client.set(
+            self.prefix + key, pickle.dumps((fingerprint, None)),
+            nx=True, ex=self.ttl)
+        if claimed:
+            return Entry(fingerprint), True
+
+        value = self._get(key)
+        if value is None:
+            # expired in between, claim it again
+            return self.begin(key, fingerprint)
+        return Entry(value[0], response=value[1]), False
+
+    def wait(self, key, entry, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = self._get(key)
+            if value is None or value[1] is not None:
+                return True
+            time.sleep(self.poll_interval)
+        return False
+
+    def complete(self, key, entry, response):
+        self.client.set(self.prefix + key,
+                        pickle.dumps((entry.fingerprint, response)),
+                        ex=self.ttl)
+
+    def fail(self, key, entry):
+        self.client.delete(self.prefix + key)
+
+
+def create_store(url=IDEMPOTENCY_URL):
+    '''
+    Uses the shared redis store if IDEMPOTENCY_URL is set
+    '''
+    if url and redis is not None:
+        return RedisIdempotencyStore(redis.Redis.from_url(url))
+    return IdempotencyStore()
+
+
+idempotency_store = create_store()
+
+
+def replay(stored):
+    body, status, headers = stored
+    response = Response(body, status, headers=headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(store=None, wait=IDEMPOTENCY_WAIT):
+    '''
+    Honours the Idempotency-Key header of a view behind requires_auth.
+    A retry with the same key and body gets the stored response without
+    running the view, concurrent duplicates wait for the first one.
+    The same key with another body is answered with 422.
+    '''
+    def idempotent_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key', None)
+            if key is None:
+                return f(payload, *args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                abort(400)
+
+            current = store or idempotency_store
+            scope = '|'.join((payload.get('sub', ''), request.method,
+                              request.path, key))
+            fingerprint = hashlib.blake2b(
+                request.get_data(), digest_size=16).digest()
+
+            deadline = time.monotonic() + wait
+            entry, owner = current.begin(scope, fingerprint)
+            while not owner:
+                if entry.fingerprint != fingerprint:
+                    abort(422)
+                if entry.response is not None:
+                    return replay(entry.response)
+
+                # the first request is still running
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or \
+                        not current.wait(scope, entry, remaining):
+                    abort(409)
+                entry, owner = current.begin(scope, fingerprint)
+
+            try:
+                response = make_response(f(payload, *args, **kwargs))
+            except Exception:
+                current.fail(scope, entry)
+                raise
+
+            if response.status_code >= 500:
+                current.fail(scope, entry)
+            else:
+                current.complete(scope, entry, (
+                    response.get_data(), response.status_code,
+                    [(name, value) for name, value in response.headers
+                     if name not in UNSTORED_HEADERS]))
+            return response
+
+        return wrapper
+    return idempotent_decorator
@@ -0,0 +1,245 @@
+import csv
+import io
+import json
+import time
+from sqlalchemy import func
+from models import db, Album, Artist
+from stats import rebuild_stats
+
+# rows sent to the database per COPY / executemany round trip
+IMPORT_CHUNK_SIZE = 10000
+
+IMPORT_COLUMNS = {
+    'albums': ('title', 'year', 'artist'),
+    'artists': ('name',)
+}
+
+# ordinal is the position of a row in the file
+STAGING_TABLES = {
+    'albums': 'CREATE TEMP TABLE albums_staging (ordinal bigint, '
+              'title varchar(120), year integer, artist varchar(120)) '
+              'ON COMMIT DROP',
+    'artists': 'CREATE TEMP TABLE artists_staging (ordinal bigint, '
+               'name varchar(120)) '
+               'ON COMMIT DROP'
+}
+
+UPSERTS = {
+    # last row wins for a duplicated title, like an UPDATE would
+    'albums': '''
+        INSERT INTO albums (title, year, artist, artist_id)
+        SELECT DISTINCT ON (s.title) s.title, s.year, s.artist,
+            (SELECT MIN(a.id) FROM artists a WHERE a.name = s.artist)
+        FROM albums_staging s
+        ORDER BY s.title, s.ordinal DESC
+        ON CONFLICT (title) DO UPDATE SET
+            year = EXCLUDED.year,
+            artist = EXCLUDED.artist,
+            artist_id = EXCLUDED.artist_id,
+            updated_at = now(),
+            version = albums.version + 1
+    ''',
+    # artist names are not unique, only names that are new get inserted,
+    # in the order of the file so ids follow it
+    'artists': '''
+        INSERT INTO artists (name)
+        SELECT s.name
+        FROM artists_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM artists a WHERE a.name = s.name)
+        GROUP BY s.name
+        ORDER BY MIN(s.ordinal)
+    '''
+}
+
+# albums imported before their artist get linked to it, see
+# Album.link_artists
+LINK_ALBUMS = '''
+    UPDATE albums SET
+        artist_id = (SELECT MIN(a.id) FROM artists a
+                     WHERE a.name = albums.artist),
+        updated_at = now(),
+        version = albums.version + 1
+    WHERE albums.artist_id IS NULL
+    AND albums.artist IN (SELECT s.name FROM artists_staging s)
+'''
+
+
+def detect_format(path):
+    if path.endswith('.ndjson') or path.endswith('.jsonl'):
+        return 'ndjson'
+    return 'csv'
+
+
+def read_rows(path, table, fmt):
+    '''
+    Streams the rows of a catalogue file, skipping incomplete rows
+    '''
+    columns = IMPORT_COLUMNS[table]
+
+    with open(path, newline='') as catalogue:
+        if fmt == 'ndjson':
+            records = (json.loads(line) for line in catalogue if line.strip())
+        else:
+            records = csv.DictReader(catalogue)
+
+        for record in records:
+            row = {column: record.get(column) for column in columns}
+            if any(value in (None, '') for value in row.values()):
+                continue
+            if 'year' in row:
+                try:
+                    row['year'] = int(row['year'])
+                except (TypeError, ValueError):
+                    continue
+            yield row
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress:
+    """Progress
+    Reports imported rows and throughput after every chunk
+    """
+
+    def __init__(self, out=print):
+        self.out = out
+        self.rows = 0
+        self.started = time.monotonic()
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def update(self, count):
+        self.rows += count
+        self.out(f'{self.rows} rows ({self.rate:.0f} rows/sec)')
+
+    def done(self):
+        elapsed = time.monotonic() - self.started
+        self.out(f'imported {self.rows} rows in {elapsed:.1f}s '
+                 f'({self.rate:.0f} rows/sec)')
+
+
+def copy_import(rows, table, chunk_size, progress):
+    '''
+    PostgreSQL: COPY every chunk into a staging table, then upsert
+    into the real table in the same transaction
+    '''
+    columns = IMPORT_COLUMNS[table]
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(STAGING_TABLES[table])
+
+        ordinal = 0
+        for chunk in chunked(rows, chunk_size):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([ordinal + offset] +
+                             [row[column] for column in columns]
+                             for offset, row in enumerate(chunk))
+            ordinal += len(chunk)
+            buffer.seek(0)
+            cursor.copy_expert(
+                f'COPY {table}_staging (ordinal, {", ".join(columns)}) '
+                'FROM STDIN WITH (FORMAT csv)',
+                buffer)
+            progress.update(len(chunk))
+
+        cursor.execute(UPSERTS[table])
+        if table == 'artists':
+            cursor.execute(LINK_ALBUMS)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def executemany_import(rows, table, chunk_size, progress):
+    '''
+    Other backends: upsert every chunk with executemany statements,
+    one transaction per chunk
+    '''
+    for chunk in chunked(rows, chunk_size):
+        if table == 'albums':
+            _upsert_albums(chunk)
+        else:
+            _insert_new_artists(chunk)
+        db.session.commit()
+        progress.update(len(chunk))
+
+
+def _upsert_albums(chunk):
+    # last row wins for a duplicated title: a later row replaces the
+    # value of its title here, and later chunks update the rows that
+    # earlier chunks committed
+    by_title = {row['title']: row for row in chunk}
+
+    names = {row['artist'] for row in by_title.values()}
+    artist_ids = dict(
+        db.session.query(Artist.name, func.min(Artist.id))
+        .filter(Artist.name.in_(names))
+        .group_by(Artist.name)
+    )
+    for row in by_title.values():
+        row['artist_id'] = artist_ids.get(row['artist'])
+
+    existing = dict(db.session.query(Album.title, Album.id)
+                    .filter(Album.title.in_(list(by_title))))
+
+    inserts = [row for title, row in by_title.items() if title not in existing]
+    updates = [dict(row, id=existing[title])
+               for title, row in by_title.items() if title in existing]
+
+    if inserts:
+        db.session.execute(Album.__table__.insert(), inserts)
+    if updates:
+        db.session.bulk_update_mappings(Album, updates)
+
+
+def _insert_new_artists(chunk):
+    # keep the order of the file so ids follow it
+    names = list(dict.fromkeys(row['name'] for row in chunk))
+    existing = {name for name, in
+                db.session.query(Artist.name).filter(Artist.name.in_(names))}
+
+    inserts = [{'name': name} for name in names if name not in existing]
+    if inserts:
+        db.session.execute(Artist.__table__.insert(), inserts)
+        Album.link_artists([row['name'] for row in inserts])
+
+
+def import_catalogue(path, table, fmt=None, chunk_size=IMPORT_CHUNK_SIZE,
+                     out=print):
+    '''
+    Imports a CSV or NDJSON catalogue file into albums or artists
+    '''
+    if table not in IMPORT_COLUMNS:
+        raise ValueError(f'Unknown table {table}')
+
+    rows = read_rows(path, table, fmt or detect_format(path))
+    progress = Progress(out)
+
+    if db.engine.dialect.name == 'postgresql':
+        copy_import(rows, table, chunk_size, progress)
+    else:
+        executemany_import(rows, table, chunk_size, progress)
+
+    # COPY and the upserts bypass the models, recount once at the end
+    if table == 'albums':
+        rebuild_stats()
+
+    progress.done()
+    return progress.rows
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# requests running more queries than this are flagged as likely N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 20))
+
+# Server-Timing exposes internals, it can be switched off in production
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in \
+    ('1', 'true', 'yes')
+
+logger = logging.getLogger('music_store.timing')
+
+
+def record(phase, seconds):
+    '''
+    Adds seconds to phase for the current request
+    '''
+    if not has_request_context():
+        return
+    timings = g.setdefault('timings', {})
+    total, count = timings.get(phase, (0.0, 0))
+    timings[phase] = (total + seconds, count + 1)
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info['query_started'].pop()
+    if has_request_context():
+        record('db', time.perf_counter() - started)
+        g.setdefault('statements', Counter())[statement] += 1
+
+
+class Instrumentation:
+    """Instrumentation
+    Times the phases of every request: auth (with the jwks key lookup
+    and jwt decoding), SQL statements, row formatting and serialization.
+    Results go out as a Server-Timing header and one structured log line
+    per request.
+    """
+
+    def __init__(self, app=None, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD,
+                 server_timing=SERVER_TIMING):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.server_timing = server_timing
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # listening on Engine covers the primary and every replica
+        if not event.contains(Engine, 'before_cursor_execute',
+                              before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         after_cursor_execute)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def start_request(self):
+        g.request_started = time.perf_counter()
+
+    def finish_request(self, response):
+        started = g.get('request_started', None)
+        if started is None:
+            return response
+
+        total = time.perf_counter() - started
+        timings = g.get('timings', {})
+        statements = g.get('statements', Counter())
+        queries = timings.get('db', (0.0, 0))[1]
+        n_plus_one = queries > self.n_plus_one_threshold
+
+        if self.server_timing:
+            metrics = []
+            for phase, (seconds, count) in timings.items():
+                metric = f'{phase};dur={seconds * 1000:.2f}'
+                if phase == 'db':
+                    metric += f';desc="{count} queries"'
+                metrics.append(metric)
+            metrics.append(f'total;dur={total * 1000:.2f}')
+            response.headers['Server-Timing'] = ', '.join(metrics)
+
+        entry = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 3),
+            'queries': queries,
+            'phases_ms': {
+                phase: round(seconds * 1000, 3)
+                for phase, (seconds, count) in timings.items()
+            }
+        }
+        if n_plus_one:
+            statement, count = statements.most_common(1)[0]
+            entry['n_plus_one'] = {'statement': statement, 'count': count}
+            logger.warning(json.dumps(entry))
+        else:
+            logger.info(json.dumps(entry))
+        return response
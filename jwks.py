@@ -0,0 +1,264 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.request import urlopen
+from Crypto.PublicKey import RSA
+
+PEM_BLOCK = re.compile(
+    r'-----BEGIN ([A-Z ]+)-----.+?-----END \1-----', re.DOTALL)
+
+
+def b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def thumbprint(jwk):
+    '''
+    Returns the RFC 7638 thumbprint of an RSA JWK, used as the kid of
+    keys that come without one
+    '''
+    canonical = json.dumps({'e': jwk['e'], 'kty': 'RSA', 'n': jwk['n']},
+                           separators=(',', ':'), sort_keys=True)
+    digest = hashlib.sha256(canonical.encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+def rsa_jwk(key, kid=None):
+    '''
+    Returns the public JWK of an RSA key from pycryptodome
+    '''
+    jwk = {'kty': 'RSA', 'use': 'sig', 'alg': 'RS256',
+           'n': b64_uint(key.n), 'e': b64_uint(key.e)}
+    jwk['kid'] = kid or thumbprint(jwk)
+    return jwk
+
+
+def load_keys(text):
+    '''
+    Parses a JWKS document, or a bundle of PEM public keys and
+    certificates whose kids are their thumbprints
+    '''
+    blocks = [match.group(0) for match in PEM_BLOCK.finditer(text)]
+    if not blocks:
+        return json.loads(text)
+    return {'keys': [rsa_jwk(RSA.import_key(block).publickey())
+                     for block in blocks]}
+
+
+def url_fetcher(url, timeout=5):
+    '''
+    Returns a fetcher that downloads a JWKS document from url
+    '''
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+
+    return fetch
+
+
+class FileFetcher:
+    """FileFetcher
+    Reads a JWKS document or PEM bundle from a local file. changed()
+    stats the file at most every check_interval seconds and tells the
+    cache to reload it after an edit.
+    """
+
+    def __init__(self, path, check_interval=1, clock=time.monotonic):
+        self.path = path
+        self.check_interval = check_interval
+        self.clock = clock
+        self._signature = None
+        self._checked_at = None
+
+    def signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def __call__(self):
+        signature = self.signature()
+        with open(self.path) as keys_file:
+            jwks = load_keys(keys_file.read())
+        self._signature = signature
+        self._checked_at = self.clock()
+        return jwks
+
+    def changed(self):
+        now = self.clock()
+        if self._checked_at is not None and \
+                now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        try:
+            return self.signature() != self._signature
+        except OSError:
+            # keep the loaded keys while the file is being replaced
+            return False
+
+
+def file_fetcher(path, check_interval=1):
+    '''
+    Returns a fetcher that reads a JWKS document from a local file
+    '''
+    return FileFetcher(path, check_interval)
+
+
+def key_source(source, timeout=5):
+    '''
+    Returns the fetcher for a key source: an http(s) JWKS url, or the
+    path of a local JWKS or PEM file
+    '''
+    if source.startswith(('http://', 'https://')):
+        return url_fetcher(source, timeout)
+    return file_fetcher(source)
+
+
+class JWKSCache:
+    """JWKSCache
+    Holds the issuer's signing keys indexed by kid.
+
+    Keys are served from memory until ttl seconds have passed. Within
+    refresh_ahead seconds of expiry a background refresh is started, an
+    unknown kid triggers at most one refetch every min_refetch_interval
+    seconds, and if the issuer cannot be reached the last known keys
+    keep being served. on_rotate is called with the kids that were
+    dropped or given another key by a refresh.
+    """
+
+    def __init__(self, fetcher, ttl=600, refresh_ahead=60,
+                 min_refetch_interval=30, background=True,
+                 clock=time.monotonic, on_rotate=None):
+        self.fetcher = fetcher
+        self.on_rotate = on_rotate
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refetch_interval = min_refetch_interval
+        self.background = background
+        self.clock = clock
+
+        self._keys = {}
+        self._expires_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.refreshes = 0
+        self.failures = 0
+
+    @property
+    def keys(self):
+        return dict(self._keys)
+
+    @property
+    def is_stale(self):
+        return self._expires_at is None or self.clock() >= self._expires_at
+
+    def refresh(self):
+        '''
+        Fetches the key set and replaces the cached keys.
+        Returns False and keeps the current keys if the fetch fails.
+        '''
+        with self._lock:
+            self._last_attempt = self.clock()
+
+        try:
+            jwks = self.fetcher()
+            keys = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use', 'sig'),
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                for key in jwks['keys'] if 'kid' in key
+            }
+        except Exception:
+            self.failures += 1
+            return False
+
+        with self._lock:
+            self.refreshes += 1
+            removed = {kid for kid, key in self._keys.items()
+                       if keys.get(kid) != key}
+            self._keys = keys
+            self._expires_at = self.clock() + self.ttl
+
+        if removed and self.on_rotate is not None:
+            self.on_rotate(removed)
+        return True
+
+    def check(self):
+        '''
+        Refreshes the keys when they are stale or about to expire, and
+        reloads a changed key file. Cheap unless a refresh is due, so it
+        runs on every request, also those served from the token cache.
+        '''
+        # local key files are reloaded as soon as they change
+        changed = getattr(self.fetcher, 'changed', None)
+        if changed is not None and changed():
+            self.refresh()
+        elif self.is_stale:
+            # blocking refresh, stale keys are kept if it fails
+            if self._can_refetch():
+                self.refresh()
+        elif self.clock() >= self._expires_at - self.refresh_ahead:
+            self._refresh_in_background()
+
+    def get_key(self, kid):
+        '''
+        Returns the key for kid, or None if the issuer does not know it
+        '''
+        self.check()
+        key = self._keys.get(kid)
+        if key is None and self._can_refetch():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def stats(self):
+        expires_in = None
+        if self._expires_at is not None:
+            expires_in = self._expires_at - self.clock()
+        return {
+            'keys': len(self._keys),
+            'stale': self.is_stale,
+            'expires_in': expires_in,
+            'refreshes': self.refreshes,
+            'failures': self.failures
+        }
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._expires_at = None
+            self._last_attempt = None
+
+    def _can_refetch(self):
+        return (self._last_attempt is None or
+                self.clock() - self._last_attempt >=
+                self.min_refetch_interval)
+
+    def _refresh_in_background(self):
+        if not self._can_refetch():
+            return
+
+        if not self.background:
+            self.refresh()
+            return
+
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
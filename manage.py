@@ -1,18 +1,99 @@
-from flask_script import Manager
+import os
+from flask_script import Manager, Command, Option
 from sqlalchemy import Column, String, Integer
 from datetime import datetime
 from flask_migrate import Migrate, MigrateCommand
 
-from app import create_app
-from models import db, Album, Artist
+from app import get_app
+from models import db, Album, Artist, TableChange
+from importer import import_catalogue, IMPORT_CHUNK_SIZE
+import stats
+import auth
+from benchmarks.issuer import LocalIssuer, ROLES
 
-app = create_app()
+def include_object(object, name, type_, reflected, compare_to):
+	# generated search columns live in the migrations, not the models
+	return not (type_ == 'column' and name == 'search_vector')
 
-migrate = Migrate(app, db, compare_type=True)
-manager = Manager(app)
+
+migrate = Migrate(db=db, compare_type=True, include_object=include_object)
+
+
+def make_app():
+	"""Builds the app when a command runs, importing manage.py
+	does not"""
+	app = get_app()
+	migrate.init_app(app)
+	return app
+
+
+manager = Manager(make_app)
 
 manager.add_command('db', MigrateCommand)
 
+
+class ImportCommand(Command):
+	"""Imports a CSV or NDJSON catalogue file, import artists first
+	so albums can be linked to them"""
+
+	option_list = (
+		Option('path'),
+		Option('--table', '-t', dest='table', required=True,
+		       choices=('albums', 'artists')),
+		Option('--format', '-f', dest='fmt', default=None,
+		       choices=('csv', 'ndjson')),
+		Option('--chunk-size', dest='chunk_size', type=int,
+		       default=IMPORT_CHUNK_SIZE),
+	)
+
+	def run(self, path, table, fmt, chunk_size):
+		import_catalogue(path, table, fmt, chunk_size)
+
+
+manager.add_command('import', ImportCommand())
+
+
+@manager.option('--out', '-o', dest='directory', default='.')
+def keygen(directory):
+	"""Writes a signing key (private.pem) and its public key as
+	public.pem and jwks.json, point AUTH_KEYS at either one"""
+	issuer = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE)
+	with open(os.path.join(directory, 'private.pem'), 'w') as key_file:
+		key_file.write(issuer.private_pem + '\n')
+	issuer.write_keys(os.path.join(directory, 'public.pem'), fmt='pem')
+	issuer.write_keys(os.path.join(directory, 'jwks.json'))
+	print(f'kid {issuer.kid}')
+
+
+@manager.option('--key', '-k', dest='key', default='private.pem')
+@manager.option('--role', '-r', dest='role', default=None,
+                choices=sorted(ROLES))
+@manager.option('--permission', '-p', dest='permissions', action='append',
+                default=[])
+@manager.option('--expires-in', dest='expires_in', type=int, default=3600)
+@manager.option('--subject', '-s', dest='subject', default='local|test')
+def mint_token(key, role, permissions, expires_in, subject):
+	"""Prints a token signed with a key from keygen, for AUTH_ISSUER
+	and AUTH_AUDIENCE"""
+	with open(key) as key_file:
+		issuer = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE,
+		                     private_pem=key_file.read())
+	print(issuer.token(ROLES.get(role, []) + permissions, expires_in,
+	                   subject))
+
+
+@manager.command
+def rebuild_stats():
+	"""Recounts the catalogue statistics from the albums table"""
+	stats.rebuild_stats()
+
+
+@manager.command
+def prune_changes():
+	"""Deletes all but the newest rows of the change log behind the
+	list ETags, run it from cron on PostgreSQL"""
+	TableChange.prune(['albums', 'artists'])
+
 # add data to the db tables
 
 
@@ -0,0 +1,337 @@
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import Response, current_app, g, request
+from auth import requires_auth
+
+# shared by all gunicorn workers, empty it before the server starts
+METRICS_DIR = os.environ.get('METRICS_DIR', None)
+
+# scrapers send a bearer token carrying this permission
+METRICS_PERMISSION = 'get:metrics'
+
+# seconds between writes of a worker's metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# type, help and how values of several processes are combined: sum over
+# every process that ever wrote them, or sum/max over live processes
+METRICS = {
+    'music_store_requests_total': (
+        'counter', 'Requests by route, method, permission and status',
+        'sum'),
+    'music_store_request_duration_seconds': (
+        'histogram', 'Request latency by route, method and permission',
+        'sum'),
+    'music_store_requests_in_flight': (
+        'gauge', 'Requests being handled', 'live_sum'),
+    'music_store_db_pool_size': (
+        'gauge', 'Connections kept open by the pool', 'live_sum'),
+    'music_store_db_pool_checked_out': (
+        'gauge', 'Connections in use', 'live_sum'),
+    'music_store_db_pool_overflow': (
+        'gauge', 'Connections opened above the pool size', 'live_sum'),
+    'music_store_db_pool_checkout_wait_seconds_total': (
+        'counter', 'Time spent waiting for a connection', 'sum'),
+    'music_store_db_pool_checkout_timeouts_total': (
+        'counter', 'Checkouts that timed out', 'sum'),
+    'music_store_jwks_keys': (
+        'gauge', 'Signing keys in the JWKS cache', 'live_max'),
+    'music_store_jwks_stale': (
+        'gauge', '1 if the JWKS cache is past its TTL', 'live_max'),
+    'music_store_jwks_refreshes_total': (
+        'counter', 'Successful JWKS fetches', 'sum'),
+    'music_store_jwks_refresh_failures_total': (
+        'counter', 'Failed JWKS fetches', 'sum'),
+    'music_store_token_cache_entries': (
+        'gauge', 'Verified tokens in the token cache', 'live_sum'),
+    'music_store_token_cache_hits_total': (
+        'counter', 'Token cache hits', 'sum'),
+    'music_store_token_cache_misses_total': (
+        'counter', 'Token cache misses', 'sum'),
+    'music_store_token_cache_evictions_total': (
+        'counter', 'Token cache evictions', 'sum'),
+    'music_store_response_cache_hits_total': (
+        'counter', 'Response cache hits', 'sum'),
+    'music_store_response_cache_misses_total': (
+        'counter', 'Response cache misses', 'sum'),
+    'music_store_response_cache_invalidations_total': (
+        'counter', 'Response cache invalidations', 'sum')
+}
+
+REQUESTS = 'music_store_requests_total'
+LATENCY = 'music_store_request_duration_seconds'
+IN_FLIGHT = 'music_store_requests_in_flight'
+
+
+def default_collectors():
+    '''
+    Collectors for the database pools, the auth caches and the response
+    cache, each returns {metric name: value} or, for labelled values,
+    {metric name: {labels: value}}
+    '''
+    from auth import jwks_cache, token_cache
+    from models import db
+    from pool import pool_status
+    from response_cache import response_cache
+
+    def pool():
+        # one engine label per pool, the primary and every replica
+        router = current_app.extensions.get('replicas')
+        engines = [('primary', db.engine)] + [
+            (f'replica{index}', engine) for index, engine
+            in enumerate(router.engines if router else [])]
+
+        values = {}
+        for name, engine in engines:
+            status = pool_status(engine)
+            samples = {
+                'music_store_db_pool_checkout_wait_seconds_total':
+                    status['checkout_wait_seconds_total'],
+                'music_store_db_pool_checkout_timeouts_total':
+                    status['checkout_timeouts']
+            }
+            if 'size' in status:
+                samples.update({
+                    'music_store_db_pool_size': status['size'],
+                    'music_store_db_pool_checked_out': status['checked_out'],
+                    'music_store_db_pool_overflow': status['overflow']
+                })
+            for metric, value in samples.items():
+                values.setdefault(metric, {})[f'engine="{name}"'] = value
+        return values
+
+    def jwks():
+        stats = jwks_cache.stats()
+        return {
+            'music_store_jwks_keys': stats['keys'],
+            'music_store_jwks_stale': int(stats['stale']),
+            'music_store_jwks_refreshes_total': stats['refreshes'],
+            'music_store_jwks_refresh_failures_total': stats['failures']
+        }
+
+    def tokens():
+        stats = token_cache.stats()
+        return {
+            'music_store_token_cache_entries': stats['size'],
+            'music_store_token_cache_hits_total': stats['hits'],
+            'music_store_token_cache_misses_total': stats['misses'],
+            'music_store_token_cache_evictions_total': stats['evictions']
+        }
+
+    def responses():
+        stats = response_cache.stats()
+        return {
+            'music_store_response_cache_hits_total': stats['hits'],
+            'music_store_response_cache_misses_total': stats['misses'],
+            'music_store_response_cache_invalidations_total':
+                stats['invalidations']
+        }
+
+    return [pool, jwks, tokens, responses]
+
+
+class Shard:
+    """Shard
+    Request counters of one thread, so they are updated without locks
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = {}
+        self.latency = {}
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics:
+    """Metrics
+    Counts requests and their latency per route, method and permission
+    and serves them with the pool and cache state at /metrics in the
+    Prometheus text format. With a directory, every worker writes its
+    values there and a scrape of any worker reports the sum of all.
+    """
+
+    def __init__(self, app=None, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL,
+                 buckets=LATENCY_BUCKETS, collectors=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.collectors = collectors
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.collectors is None:
+            self.collectors = default_collectors()
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics',
+                         requires_auth(METRICS_PERMISSION)(self.metrics_view))
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def start_request(self):
+        self.shard().in_flight += 1
+        g.metrics_started = time.perf_counter()
+
+    def teardown_request(self, exc=None):
+        if g.pop('metrics_started', None) is not None:
+            self.shard().in_flight -= 1
+
+    def finish_request(self, response):
+        started = g.get('metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = f'route="{rule}",method="{request.method}",' \
+            f'permission="{g.get("permission", "")}"'
+        shard = self.shard()
+
+        key = f'{labels},status="{response.status_code}"'
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+
+        counts = shard.latency.get(labels)
+        if counts is None:
+            # one slot per bucket, +Inf, then the sum
+            counts = shard.latency[labels] = [0] * (len(self.buckets) + 1) \
+                + [0.0]
+        counts[bisect.bisect_left(self.buckets, elapsed)] += 1
+        counts[-1] += elapsed
+
+        if self.directory and \
+                time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return response
+
+    def snapshot(self):
+        '''
+        Returns this process' values as {metric name: {labels: value}}
+        '''
+        values = {REQUESTS: {}, LATENCY: {}, IN_FLIGHT: {'': 0}}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            values[IN_FLIGHT][''] += shard.in_flight
+            for key, count in shard.requests.copy().items():
+                values[REQUESTS][key] = values[REQUESTS].get(key, 0) + count
+            for key, counts in shard.latency.copy().items():
+                merged = values[LATENCY].setdefault(
+                    key, [0] * (len(counts) - 1) + [0.0])
+                for index, count in enumerate(list(counts)):
+                    merged[index] += count
+
+        for collector in self.collectors or []:
+            for name, value in collector().items():
+                values[name] = value if isinstance(value, dict) \
+                    else {'': value}
+        return values
+
+    def flush(self):
+        '''
+        Writes this process' values to the shared directory
+        '''
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary, path)
+
+    def collect(self):
+        '''
+        Returns the values of all processes as (values, alive) pairs
+        '''
+        if not self.directory:
+            return [(self.snapshot(), True)]
+
+        self.flush()
+        processes = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            pid = int(os.path.basename(path)[8:-5])
+            try:
+                with open(path) as file:
+                    processes.append((json.load(file), is_alive(pid)))
+            except (OSError, ValueError):
+                continue
+        return processes
+
+    def aggregate(self):
+        totals = {}
+        for values, alive in self.collect():
+            for name, samples in values.items():
+                if name not in METRICS:
+                    continue
+                kind, _, mode = METRICS[name]
+                if mode != 'sum' and not alive:
+                    continue
+                merged = totals.setdefault(name, {})
+                for key, value in samples.items():
+                    if kind == 'histogram':
+                        current = merged.setdefault(key, [0] * len(value))
+                        for index, count in enumerate(value):
+                            current[index] += count
+                    elif mode == 'live_max':
+                        merged[key] = max(merged.get(key, value), value)
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+        return totals
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        totals = self.aggregate()
+        for name, (kind, description, _) in METRICS.items():
+            if name not in totals:
+                continue
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(totals[name].items()):
+                if kind != 'histogram':
+                    labels = '{' + key + '}' if key else ''
+                    lines.append(f'{name}{labels} {value}')
+                    continue
+
+                cumulative = 0
+                bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{{key},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{key}}} {value[-1]}')
+                lines.append(f'{name}_count{{{key}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self, jwt):
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
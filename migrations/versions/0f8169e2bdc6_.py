@@ -0,0 +1,44 @@
+"""link albums to artists
+
+Revision ID: 0f8169e2bdc6
+Revises: a5927549739e
+Create Date: 2026-10-18 09:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0f8169e2bdc6'
+down_revision = 'a5927549739e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('albums', sa.Column('artist_id', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_albums_artist_id'), 'albums', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_artists_name'), 'artists', ['name'], unique=False)
+
+    # backfill from the free text artist names, the first artist wins
+    op.execute(
+        'UPDATE albums SET artist_id = ('
+        'SELECT MIN(artists.id) FROM artists '
+        'WHERE artists.name = albums.artist)'
+    )
+
+    with op.batch_alter_table('albums') as batch_op:
+        batch_op.create_foreign_key(
+            'fk_albums_artist_id_artists', 'artists',
+            ['artist_id'], ['id'], ondelete='SET NULL')
+
+
+def downgrade():
+    with op.batch_alter_table('albums') as batch_op:
+        batch_op.drop_constraint(
+            'fk_albums_artist_id_artists', type_='foreignkey')
+
+    op.drop_index(op.f('ix_artists_name'), table_name='artists')
+    op.drop_index(op.f('ix_albums_artist_id'), table_name='albums')
+    op.drop_column('albums', 'artist_id')
@@ -0,0 +1,42 @@
+"""row versions for albums and artists
+
+Revision ID: 3d94a6f0c2b7
+Revises: 7c2e4b1d9a03
+Create Date: 2026-10-18 12:03:55.207631
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d94a6f0c2b7'
+down_revision = '7c2e4b1d9a03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sqlite can only add columns with a constant default
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    updated_at_default = sa.text("'1970-01-01 00:00:00'") if sqlite \
+        else sa.func.now()
+
+    for table in ('albums', 'artists'):
+        op.add_column(table, sa.Column(
+            'updated_at', sa.DateTime(), nullable=False,
+            server_default=updated_at_default))
+        op.add_column(table, sa.Column(
+            'version', sa.Integer(), nullable=False, server_default='1'))
+        if sqlite:
+            op.execute(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP')
+        op.create_index(
+            op.f(f'ix_{table}_updated_at'), table, ['updated_at'],
+            unique=False)
+
+
+def downgrade():
+    for table in ('artists', 'albums'):
+        op.drop_index(op.f(f'ix_{table}_updated_at'), table_name=table)
+        op.drop_column(table, 'version')
+        op.drop_column(table, 'updated_at')
@@ -0,0 +1,56 @@
+"""stored search vectors for albums and artists
+
+Revision ID: 4e6a8c0b2d15
+Revises: bf4425499ee4
+Create Date: 2026-10-18 23:12:40.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e6a8c0b2d15'
+down_revision = 'bf4425499ee4'
+branch_labels = None
+depends_on = None
+
+
+# the vectors are computed once per write (PostgreSQL 12+), so ranking
+# reads them instead of parsing every matching row again; search.py
+# ranks and filters on the same columns the GIN indexes cover
+VECTORS = {
+    'albums': "to_tsvector('simple', title || ' ' || artist)",
+    'artists': "to_tsvector('simple', name)",
+}
+
+POSTGRES_UPGRADE = [
+    statement for table, vector in VECTORS.items() for statement in (
+        f"DROP INDEX ix_{table}_search",
+        f"ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+        f"GENERATED ALWAYS AS ({vector}) STORED",
+        f"CREATE INDEX ix_{table}_search ON {table} "
+        "USING gin (search_vector)",
+    )
+]
+
+POSTGRES_DOWNGRADE = [
+    statement for table, vector in VECTORS.items() for statement in (
+        f"DROP INDEX ix_{table}_search",
+        f"ALTER TABLE {table} DROP COLUMN search_vector",
+        f"CREATE INDEX ix_{table}_search ON {table} USING gin ({vector})",
+    )
+]
+
+
+# SQLite keeps using the FTS5 tables of migration 7c2e4b1d9a03
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for statement in POSTGRES_UPGRADE:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for statement in POSTGRES_DOWNGRADE:
+            op.execute(statement)
@@ -0,0 +1,44 @@
+"""catalogue statistics
+
+Revision ID: 5e8a0d2c4f61
+Revises: 9b1f5c3e7a24
+Create Date: 2026-10-18 17:22:40.118730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8a0d2c4f61'
+down_revision = '9b1f5c3e7a24'
+branch_labels = None
+depends_on = None
+
+
+# the statements must match stats.REBUILD
+POPULATE = [
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'total', '', count(*) FROM albums",
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'artist', artist, count(*) FROM albums GROUP BY artist",
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'decade', CAST(year / 10 * 10 AS VARCHAR(16)), count(*) "
+    "FROM albums GROUP BY year / 10 * 10",
+]
+
+
+def upgrade():
+    op.create_table(
+        'catalogue_stats',
+        sa.Column('dimension', sa.String(length=16), nullable=False),
+        sa.Column('bucket', sa.String(length=120), nullable=False),
+        sa.Column('albums', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('dimension', 'bucket')
+    )
+    for statement in POPULATE:
+        op.execute(statement)
+
+
+def downgrade():
+    op.drop_table('catalogue_stats')
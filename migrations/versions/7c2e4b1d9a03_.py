@@ -0,0 +1,90 @@
+"""search indexes for albums and artists
+
+Revision ID: 7c2e4b1d9a03
+Revises: 0f8169e2bdc6
+Create Date: 2026-10-18 10:41:07.518392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e4b1d9a03'
+down_revision = '0f8169e2bdc6'
+branch_labels = None
+depends_on = None
+
+
+# replaced by stored search_vector columns in migration 4e6a8c0b2d15
+POSTGRES_UPGRADE = [
+    "CREATE INDEX ix_albums_search ON albums USING gin "
+    "(to_tsvector('simple', title || ' ' || artist))",
+    "CREATE INDEX ix_artists_search ON artists USING gin "
+    "(to_tsvector('simple', name))",
+]
+
+POSTGRES_DOWNGRADE = [
+    "DROP INDEX ix_artists_search",
+    "DROP INDEX ix_albums_search",
+]
+
+# external content FTS5 tables kept in sync by triggers
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE albums_fts USING fts5"
+    "(title, artist, content='albums', content_rowid='id')",
+    "CREATE TRIGGER albums_fts_insert AFTER INSERT ON albums BEGIN "
+    "INSERT INTO albums_fts(rowid, title, artist) "
+    "VALUES (new.id, new.title, new.artist); END",
+    "CREATE TRIGGER albums_fts_delete AFTER DELETE ON albums BEGIN "
+    "INSERT INTO albums_fts(albums_fts, rowid, title, artist) "
+    "VALUES ('delete', old.id, old.title, old.artist); END",
+    "CREATE TRIGGER albums_fts_update AFTER UPDATE ON albums BEGIN "
+    "INSERT INTO albums_fts(albums_fts, rowid, title, artist) "
+    "VALUES ('delete', old.id, old.title, old.artist); "
+    "INSERT INTO albums_fts(rowid, title, artist) "
+    "VALUES (new.id, new.title, new.artist); END",
+    "INSERT INTO albums_fts(albums_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE artists_fts USING fts5"
+    "(name, content='artists', content_rowid='id')",
+    "CREATE TRIGGER artists_fts_insert AFTER INSERT ON artists BEGIN "
+    "INSERT INTO artists_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER artists_fts_delete AFTER DELETE ON artists BEGIN "
+    "INSERT INTO artists_fts(artists_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER artists_fts_update AFTER UPDATE ON artists BEGIN "
+    "INSERT INTO artists_fts(artists_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); "
+    "INSERT INTO artists_fts(rowid, name) VALUES (new.id, new.name); END",
+    "INSERT INTO artists_fts(artists_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER artists_fts_update",
+    "DROP TRIGGER artists_fts_delete",
+    "DROP TRIGGER artists_fts_insert",
+    "DROP TABLE artists_fts",
+    "DROP TRIGGER albums_fts_update",
+    "DROP TRIGGER albums_fts_delete",
+    "DROP TRIGGER albums_fts_insert",
+    "DROP TABLE albums_fts",
+]
+
+
+def _statements(postgres, sqlite):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgres
+    if dialect == 'sqlite':
+        return sqlite
+    return []
+
+
+def upgrade():
+    for statement in _statements(POSTGRES_UPGRADE, SQLITE_UPGRADE):
+        op.execute(statement)
+
+
+def downgrade():
+    for statement in _statements(POSTGRES_DOWNGRADE, SQLITE_DOWNGRADE):
+        op.execute(statement)
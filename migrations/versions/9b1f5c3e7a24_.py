@@ -0,0 +1,27 @@
+"""indexes for album filters and counts
+
+Revision ID: 9b1f5c3e7a24
+Revises: 3d94a6f0c2b7
+Create Date: 2026-10-18 15:41:12.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1f5c3e7a24'
+down_revision = '3d94a6f0c2b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_albums_artist_year', 'albums', ['artist', 'year'],
+                    unique=False)
+    op.create_index('ix_albums_year', 'albums', ['year'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_albums_year', table_name='albums')
+    op.drop_index('ix_albums_artist_year', table_name='albums')
@@ -0,0 +1,99 @@
+"""change log for albums and artists
+
+Revision ID: bf4425499ee4
+Revises: 5e8a0d2c4f61
+Create Date: 2026-10-18 21:06:52.731904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bf4425499ee4'
+down_revision = '5e8a0d2c4f61'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ('albums', 'artists')
+EVENTS = (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))
+
+# every write statement appends a row, so writers never wait on each
+# other; statements that change no rows are skipped through the
+# transition table. Ids are taken in start order, not commit order,
+# readers use the highest id and the number of rows.
+POSTGRES_UPGRADE = [
+    "CREATE FUNCTION log_table_change() RETURNS trigger AS $$ "
+    "BEGIN "
+    "IF EXISTS (SELECT 1 FROM changed) THEN "
+    "INSERT INTO table_changes (name, changed_at) "
+    "VALUES (TG_TABLE_NAME, clock_timestamp() AT TIME ZONE 'utc'); "
+    "END IF; "
+    "RETURN NULL; "
+    "END $$ LANGUAGE plpgsql",
+] + [
+    f"CREATE TRIGGER {table}_changes_{event.lower()} "
+    f"AFTER {event} ON {table} REFERENCING {rows} TABLE AS changed "
+    "FOR EACH STATEMENT EXECUTE PROCEDURE log_table_change()"
+    for table in TABLES for event, rows in EVENTS
+]
+
+POSTGRES_DOWNGRADE = [
+    f"DROP TRIGGER {table}_changes_{event.lower()} ON {table}"
+    for table in TABLES for event, _ in EVENTS
+] + [
+    "DROP FUNCTION log_table_change()",
+]
+
+# SQLite only has row triggers and one writer at a time, so only the
+# newest row of a table is kept
+SQLITE_UPGRADE = [
+    f"CREATE TRIGGER {table}_changes_{event.lower()} "
+    f"AFTER {event} ON {table} BEGIN "
+    "INSERT INTO table_changes (name, changed_at) "
+    f"VALUES ('{table}', datetime('now')); "
+    f"DELETE FROM table_changes WHERE name = '{table}' "
+    "AND id < last_insert_rowid(); END"
+    for table in TABLES for event, _ in EVENTS
+]
+
+SQLITE_DOWNGRADE = [
+    f"DROP TRIGGER {table}_changes_{event.lower()}"
+    for table in TABLES for event, _ in EVENTS
+]
+
+
+def _statements(postgres, sqlite):
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgres
+    if dialect == 'sqlite':
+        return sqlite
+    return []
+
+
+def upgrade():
+    op.create_table(
+        'table_changes',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                  nullable=False),
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_table_changes_name_id', 'table_changes',
+                    ['name', 'id'], unique=False)
+    for table in TABLES:
+        op.execute(
+            "INSERT INTO table_changes (name, changed_at) "
+            f"SELECT '{table}', MAX(updated_at) FROM {table}")
+    for statement in _statements(POSTGRES_UPGRADE, SQLITE_UPGRADE):
+        op.execute(statement)
+
+
+def downgrade():
+    for statement in _statements(POSTGRES_DOWNGRADE, SQLITE_DOWNGRADE):
+        op.execute(statement)
+    op.drop_index('ix_table_changes_name_id', table_name='table_changes')
+    op.drop_table('table_changes')
@@ -1,25 +1,45 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, \
+    ForeignKey, Index
+from sqlalchemy import event, func, text, inspect, select, or_
+from sqlalchemy.orm import relationship
+from pool import pool_options
+from replicas import DATABASE_REPLICA_URLS, ReplicaRouter, RoutingSQLAlchemy
 
-# get database details from environment variables
-dev_db_url = os.environ['DATABASE_URL']
-test_db_url = os.environ['TEST_DATABASE_URL']
-env = os.environ['FLASK_ENV']
+# instantiate SQLALchemy as db, its session can route reads to replicas
+db = RoutingSQLAlchemy()
 
-# Use test database or dev database according to environment
-database_url = test_url if env == 'test' else dev_db_url
+'''
+get_database_url()
+    reads the database details from environment variables when the app
+    is created, not when this module is imported
+    uses the test database when FLASK_ENV is test
+'''
+def get_database_url(environ=os.environ):
+    if environ.get('FLASK_ENV') == 'test':
+        return environ['TEST_DATABASE_URL']
+    return environ['DATABASE_URL']
 
-# instantiate SQLALchemy as db
-db = SQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    database_url defaults to get_database_url()
+    pool settings come from the DB_POOL_* environment variables,
+    entries in pool override them
+    read only routes use replica_urls when given
 '''
-def setup_db(app, database_url=database_url):
+def setup_db(app, database_url=None, pool=None,
+             replica_urls=DATABASE_REPLICA_URLS):
+    database_url = database_url or get_database_url()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = pool_options(database_url, pool)
+    if replica_urls:
+        ReplicaRouter(replica_urls, pool=pool).init_app(app)
+    else:
+        app.extensions.pop('replicas', None)
     db.app = app
     db.init_app(app)
 
@@ -27,13 +47,88 @@ def setup_db(app, database_url=database_url):
 # Setup Album model inherits from db.model;
 class Album(db.Model):
     __tablename__ = 'albums'
+    # serve ?artist=, ?year_from=/?year_to= and the counts per year/artist
+    __table_args__ = (
+        Index('ix_albums_artist_year', 'artist', 'year'),
+        Index('ix_albums_year', 'year'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String(120), unique=True, nullable=False)
     year = Column(Integer, nullable=False)
     artist = Column(String(120), nullable=False)
+    artist_id = Column(
+        Integer,
+        ForeignKey(
+            'artists.id',
+            name='fk_albums_artist_id_artists',
+            ondelete='SET NULL'),
+        nullable=True,
+        index=True)
+
+    # bumped on every UPDATE, including bulk and Core updates
+    updated_at = Column(
+        DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=func.now(),
+        index=True)
+    version = Column(
+        Integer,
+        nullable=False,
+        default=1,
+        onupdate=text('version + 1'),
+        server_default='1')
+
+    # columns that can be selected through ?fields=
+    public_fields = ('id', 'title', 'year', 'artist', 'artist_id')
+
+    # columns that can be ordered by through ?sort=
+    sortable_fields = ('id', 'title', 'year', 'artist')
+
+    def link_artist(self):
+        '''
+        Points artist_id at the artist whose name matches artist
+        '''
+        artist = Artist.query.filter(Artist.name == self.artist) \
+            .order_by(Artist.id).first()
+        self.artist_id = artist.id if artist else None
+
+    @staticmethod
+    def lock(*criteria):
+        '''
+        Locks the matching albums in id order. Writes to albums and
+        artists, or albums and the statistics, take the album rows first
+        so concurrent writers never wait on each other in a circle.
+        SQLite locks the whole database instead.
+        '''
+        if db.engine.dialect.name == 'sqlite':
+            return
+        with db.session.no_autoflush:
+            db.session.query(Album.id).filter(*criteria) \
+                .order_by(Album.id).with_for_update().all()
+
+    @staticmethod
+    def link_artists(names):
+        '''
+        Points the albums of the given artist names at the first artist
+        with that name, like link_artist does for a new album. Albums
+        saved before their artist was created or renamed are linked this
+        way. Only rows whose link changes are updated, which bumps their
+        version.
+        '''
+        first = select([func.min(Artist.id)]) \
+            .where(Artist.name == Album.artist).as_scalar()
+        return Album.query.filter(
+            Album.artist.in_(list(names)),
+            first.isnot(None),
+            or_(Album.artist_id.is_(None), Album.artist_id != first)) \
+            .update({Album.artist_id: first}, synchronize_session=False)
 
     def insert(self):
+        if self.artist_id is None:
+            self.link_artist()
         db.session.add(self)
         db.session.commit()
 
@@ -49,7 +144,8 @@ class Album(db.Model):
             'id': self.id,
             'title': self.title,
             'year': self.year,
-            'artist':self.artist
+            'artist':self.artist,
+            'artist_id': self.artist_id
             }
 
 
@@ -58,17 +154,51 @@ class Artist(db.Model):
     __tablename__ = 'artists'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(120), nullable=False)
+    name = Column(String(120), nullable=False, index=True)
+
+    # bumped on every UPDATE, including bulk and Core updates
+    updated_at = Column(
+        DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=func.now(),
+        index=True)
+    version = Column(
+        Integer,
+        nullable=False,
+        default=1,
+        onupdate=text('version + 1'),
+        server_default='1')
+
+    # load with selectinload(Artist.albums) to batch the album queries,
+    # delete unlinks the albums without loading them
+    albums = relationship('Album', order_by='Album.id', lazy='select',
+                          passive_deletes=True)
+
+    # columns that can be selected through ?fields=
+    public_fields = ('id', 'name')
 
     def insert(self):
+        Album.lock(Album.artist == self.name)
         db.session.add(self)
+        db.session.flush()
+        Album.link_artists([self.name])
         db.session.commit()
 
     def delete(self):
+        Album.lock(Album.artist_id == self.id)
+        # one UPDATE that bumps the versions of the albums, the database's
+        # ON DELETE SET NULL would leave their ETags unchanged
+        Album.query.filter(Album.artist_id == self.id) \
+            .update({Album.artist_id: None}, synchronize_session=False)
         db.session.delete(self)
         db.session.commit()
 
     def update(self):
+        Album.lock(Album.artist == self.name)
+        db.session.flush()
+        Album.link_artists([self.name])
         db.session.commit()
 
     def format(self):
@@ -76,3 +206,113 @@ class Artist(db.Model):
             'id': self.id,
             'name': self.name,
             }
+
+
+# Album counts kept up to date by every album write, so dashboards
+# never have to scan albums
+class CatalogueStat(db.Model):
+    __tablename__ = 'catalogue_stats'
+
+    # 'total' (bucket ''), 'artist' (artist name) or 'decade' ('1960')
+    dimension = Column(String(16), primary_key=True)
+    bucket = Column(String(120), primary_key=True)
+    albums = Column(Integer, nullable=False, default=0)
+
+    # the same syntax works on PostgreSQL and SQLite 3.24+
+    UPSERT = text('''
+        INSERT INTO catalogue_stats (dimension, bucket, albums)
+        VALUES (:dimension, :bucket, :albums)
+        ON CONFLICT (dimension, bucket)
+        DO UPDATE SET albums = catalogue_stats.albums + excluded.albums
+    ''')
+
+    @staticmethod
+    def album_deltas(added=(), removed=()):
+        '''
+        Returns {(dimension, bucket): change} for albums given as
+        (artist, year) pairs
+        '''
+        deltas = {}
+        for pairs, sign in ((added, 1), (removed, -1)):
+            for artist, year in pairs:
+                for key in (('total', ''), ('artist', artist),
+                            ('decade', str(int(year) // 10 * 10))):
+                    deltas[key] = deltas.get(key, 0) + sign
+        return deltas
+
+    @classmethod
+    def apply(cls, deltas, connection=None):
+        '''
+        Adds deltas in the current transaction. Rows are updated in key
+        order so concurrent writers lock them in the same order.
+        '''
+        changes = [
+            {'dimension': dimension, 'bucket': bucket, 'albums': change}
+            for (dimension, bucket), change in sorted(deltas.items())
+            if change
+        ]
+        if changes:
+            (connection or db.session).execute(cls.UPSERT, changes)
+
+
+# Appended by database triggers on every statement that writes albums or
+# artists (migration bf4425499ee4), whichever path the write takes
+class TableChange(db.Model):
+    __tablename__ = 'table_changes'
+    __table_args__ = (
+        Index('ix_table_changes_name_id', 'name', 'id'),
+    )
+
+    id = Column(BigInteger().with_variant(Integer(), 'sqlite'),
+                primary_key=True)
+    name = Column(String(32), nullable=False)
+    changed_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def prune(cls, names):
+        '''
+        Deletes all but the newest change of each table. A new row is
+        added first so the highest id moves on and a pruned log never
+        looks like an earlier one; rows of transactions still running
+        are not visible here and survive.
+        '''
+        for name in names:
+            # keeps Last-Modified where the writes left it
+            changed_at = db.session.query(func.max(cls.changed_at)) \
+                .filter(cls.name == name).scalar()
+            marker = cls(name=name, changed_at=changed_at)
+            db.session.add(marker)
+            db.session.flush()
+            cls.query.filter(cls.name == name, cls.id < marker.id) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def previous(album, name):
+    '''
+    Returns the value a column of album had before the pending change
+    '''
+    history = inspect(album).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(album, name)
+
+
+# Album.insert, update and delete count their album in the flush that
+# writes it; bulk writes skip these events and call apply themselves
+@event.listens_for(Album, 'after_insert')
+def count_inserted_album(mapper, connection, album):
+    CatalogueStat.apply(CatalogueStat.album_deltas(
+        added=[(album.artist, album.year)]), connection)
+
+
+@event.listens_for(Album, 'after_update')
+def count_updated_album(mapper, connection, album):
+    CatalogueStat.apply(CatalogueStat.album_deltas(
+        added=[(album.artist, album.year)],
+        removed=[(previous(album, 'artist'), previous(album, 'year'))]),
+        connection)
+
+
+@event.listens_for(Album, 'after_delete')
+def count_deleted_album(mapper, connection, album):
+    CatalogueStat.apply(CatalogueStat.album_deltas(
+        removed=[(album.artist, album.year)]), connection)
@@ -0,0 +1,219 @@
+import base64
+import binascii
+import json
+from flask import abort
+from sqlalchemy import and_, or_
+from models import db
+from instrumentation import timed
+
+# upper bound for ?limit= so a single page stays cheap
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id, keys=None):
+    '''
+    Encodes the last primary key of a page as an opaque cursor, or the
+    values of its sort keys when the page is sorted
+    '''
+    data = {'id': last_id} if keys is None else {'keys': keys}
+    raw = json.dumps(data).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Decodes a cursor produced by encode_cursor, 400 if it is invalid.
+    Returns the primary key, or the list of sort key values.
+    '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if 'keys' in data:
+            keys = data['keys']
+            if not isinstance(keys, list) or not keys:
+                abort(400)
+            return keys
+        last_id = data['id']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        abort(400)
+
+    if not isinstance(last_id, int):
+        abort(400)
+    return last_id
+
+
+def get_page_args(args):
+    '''
+    Reads ?limit= and ?after= from the query string
+    '''
+    limit = args.get('limit', None)
+    after = args.get('after', None)
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400)
+        if limit < 1:
+            abort(400)
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    if after is not None:
+        after = decode_cursor(after)
+
+    return limit, after
+
+
+def get_fields(args, model):
+    '''
+    Reads ?fields= and returns the requested column names.
+    The primary key is always selected since cursors are built from it.
+    '''
+    fields = args.get('fields', None)
+    if not fields:
+        return list(model.public_fields)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    if not names or any(name not in model.public_fields for name in names):
+        abort(400)
+
+    if 'id' not in names:
+        names.insert(0, 'id')
+    return names
+
+
+def get_sort(args, model):
+    '''
+    Reads ?sort= as a list of model.sortable_fields, a leading - sorts
+    that field in descending order. Returns [(field, descending)] with
+    the primary key last so the order is total, [] if no sort is given.
+    '''
+    sort = args.get('sort', None)
+    if not sort:
+        return []
+
+    order = []
+    for name in sort.split(','):
+        name = name.strip()
+        descending = name.startswith('-')
+        name = name[1:] if descending else name
+        if name not in model.sortable_fields or \
+                name in [field for field, _ in order]:
+            abort(400)
+        order.append((name, descending))
+
+    if 'id' not in [field for field, _ in order]:
+        order.append(('id', False))
+    return order
+
+
+def column_query(model, fields=None):
+    '''
+    Selects fields (default model.public_fields) as plain tuples so rows
+    skip ORM object hydration
+    '''
+    columns = [getattr(model, name) for name in fields or model.public_fields]
+    return db.session.query(*columns)
+
+
+def rows_to_dicts(fields, rows):
+    with timed('format'):
+        return [dict(zip(fields, row)) for row in rows]
+
+
+def valid_key(column, value):
+    '''
+    Checks that a cursor value has the Python type of its column, cursors
+    come from the client and must not reach the SQL as anything else
+    '''
+    return isinstance(value, column.type.python_type) and \
+        not isinstance(value, bool)
+
+
+def after_keys(model, order, keys):
+    '''
+    Matches the rows sorted after the row with the given sort key values:
+    (a > x) OR (a = x AND b > y) OR ..., with < for descending keys
+    '''
+    if len(keys) != len(order) or not all(
+            valid_key(getattr(model, name), value)
+            for (name, _), value in zip(order, keys)):
+        abort(400)
+
+    clauses = []
+    for index, (name, descending) in enumerate(order):
+        column = getattr(model, name)
+        equal = [getattr(model, previous) == value for (previous, _), value
+                 in zip(order[:index], keys[:index])]
+        after = column < keys[index] if descending \
+            else column > keys[index]
+        clauses.append(and_(*equal, after))
+    return or_(*clauses)
+
+
+def sorted_query(model, fields, after=None, criteria=(), order=()):
+    '''
+    Selects fields of the rows matching criteria after the cursor, in
+    the given order or by primary key. Sort keys missing from fields
+    are selected after them.
+    '''
+    names = list(fields) + [name for name, _ in order if name not in fields]
+    query = column_query(model, names).filter(*criteria)
+
+    if not order:
+        if isinstance(after, list):
+            abort(400)
+        query = query.order_by(model.id)
+        if after is not None:
+            query = query.filter(model.id > after)
+        return query, names
+
+    if after is not None:
+        if not isinstance(after, list):
+            abort(400)
+        query = query.filter(after_keys(model, order, after))
+    query = query.order_by(*[
+        getattr(model, name).desc() if descending else getattr(model, name)
+        for name, descending in order
+    ])
+    return query, names
+
+
+def keyset_rows(model, fields, limit=None, after=None, criteria=(),
+                order=()):
+    '''
+    Selects one page of tuple rows matching criteria, ordered by primary
+    key or by the (field, descending) pairs in order.
+    Returns the rows and the cursor for the next page.
+    '''
+    query, names = sorted_query(model, fields, after, criteria, order)
+
+    if limit is None:
+        rows = query.all()
+        has_more = False
+    else:
+        # fetch one extra row to know if there is a next page
+        rows = query.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and order:
+        next_cursor = encode_cursor(None, [
+            rows[-1][names.index(name)] for name, _ in order])
+    elif has_more:
+        next_cursor = encode_cursor(rows[-1][names.index('id')])
+
+    if len(names) > len(fields):
+        rows = [row[:len(fields)] for row in rows]
+    return rows, next_cursor
+
+
+def keyset_page(model, fields, limit=None, after=None, criteria=(),
+                order=()):
+    '''
+    Like keyset_rows but returns the rows as dicts
+    '''
+    rows, next_cursor = keyset_rows(model, fields, limit, after, criteria,
+                                    order)
+    return rows_to_dicts(fields, rows), next_cursor
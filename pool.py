@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+# environment variables read by pool_options and their defaults
+POOL_SETTINGS = {
+    'pool_size': ('DB_POOL_SIZE', int, 5),
+    'max_overflow': ('DB_MAX_OVERFLOW', int, 10),
+    'pool_timeout': ('DB_POOL_TIMEOUT', int, 30),
+    'pool_recycle': ('DB_POOL_RECYCLE', int, 1800),
+    'pool_pre_ping': ('DB_POOL_PRE_PING', lambda value: value.lower() in
+                      ('1', 'true', 'yes'), True),
+    'pooler': ('DB_POOLER', str, None)
+}
+
+
+class PoolMetrics:
+    """PoolMetrics
+    Time spent waiting for a pool connection and checkout timeouts of
+    one pool
+    """
+
+    def __init__(self):
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, timed_out=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def stats(self):
+        return {
+            'checkout_waits': self.waits,
+            'checkout_wait_seconds_total': self.wait_total,
+            'checkout_wait_seconds_max': self.wait_max,
+            'checkout_timeouts': self.timeouts
+        }
+
+
+class TimedQueuePool(QueuePool):
+    """TimedQueuePool
+    QueuePool that records in its metrics how long each checkout waited
+    for a free connection. Opening a new connection is not waiting, the
+    time it takes is left out.
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30,
+                 **kw):
+        super().__init__(creator, pool_size=pool_size,
+                         max_overflow=max_overflow, timeout=timeout, **kw)
+        self.capacity = pool_size + max_overflow if max_overflow >= 0 \
+            else None
+        self.metrics = PoolMetrics()
+        self._checkout = threading.local()
+
+    def recreate(self):
+        # engine.dispose() replaces the pool, the counters carry on
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            self._checkout.connecting = getattr(
+                self._checkout, 'connecting', 0.0) + \
+                time.perf_counter() - started
+
+    def _do_get(self):
+        # QueuePool._do_get retries by calling itself, time the outer call
+        if getattr(self._checkout, 'active', False):
+            return super()._do_get()
+
+        self._checkout.active = True
+        self._checkout.connecting = 0.0
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self._checkout.active = False
+            self.metrics.observe(
+                time.perf_counter() - started - self._checkout.connecting,
+                timed_out)
+
+
+def pool_options(database_url, overrides=None, environ=os.environ):
+    '''
+    Returns SQLALCHEMY_ENGINE_OPTIONS for database_url from the DB_POOL_*
+    environment variables, overrides take precedence
+    '''
+    settings = {}
+    for option, (variable, parse, default) in POOL_SETTINGS.items():
+        value = environ.get(variable, None)
+        settings[option] = parse(value) if value is not None else default
+    settings.update(overrides or {})
+
+    # sqlite uses its own pool implementations
+    if database_url.startswith('sqlite'):
+        return {}
+
+    # with PgBouncer in transaction mode the pooling happens there, a
+    # server connection is only ours for one transaction so nothing
+    # session level (prepared statements, SET) may be relied on
+    if settings['pooler'] == 'pgbouncer':
+        return {
+            'poolclass': NullPool,
+            'pool_pre_ping': settings['pool_pre_ping']
+        }
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping']
+    }
+
+
+def pool_status(engine):
+    '''
+    Returns the current pool utilization together with the wait metrics
+    of the pool of engine
+    '''
+    pool = engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return PoolMetrics().stats()
+
+    status = pool.metrics.stats()
+    checked_out = pool.checkedout()
+    status.update({
+        'size': pool.size(),
+        'checked_out': checked_out,
+        'overflow': pool.overflow(),
+        'utilization': checked_out / pool.capacity
+        if pool.capacity else None
+    })
+    return status
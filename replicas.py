@@ -0,0 +1,192 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import create_engine, event, orm
+from pool import pool_options
+from token_cache import token_key
+
+# comma separated replica URLs, reads stay on the primary when empty
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '')
+    .split(',') if url.strip()
+]
+REPLICA_STRATEGY = os.environ.get('REPLICA_STRATEGY', 'round_robin')
+
+# a client reads from the primary for this long after it wrote
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+REPLICA_STICKY_SIZE = 10000
+# signs the sticky cookie, workers forked from one preloaded app share the
+# random default, set it when running several hosts
+REPLICA_STICKY_SECRET = os.environ.get('REPLICA_STICKY_SECRET') or \
+    os.urandom(32).hex()
+REPLICA_STICKY_COOKIE = 'read_primary_until'
+
+REPLICA_STRATEGIES = ('round_robin', 'least_connections')
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaRouter:
+    """ReplicaRouter
+    Picks a replica engine for read only requests and remembers which
+    clients wrote recently so they keep reading from the primary.
+    Writers get a signed cookie with the end of their sticky window so
+    every worker can check it, the process also remembers them for
+    clients that don't send cookies back.
+    """
+
+    def __init__(self, urls, strategy=REPLICA_STRATEGY,
+                 sticky_seconds=REPLICA_STICKY_SECONDS, pool=None,
+                 clock=time.time, secret=REPLICA_STICKY_SECRET):
+        if strategy not in REPLICA_STRATEGIES:
+            raise ValueError(f'unknown replica strategy {strategy}')
+
+        self.engines = [
+            create_engine(url, **pool_options(url, pool)) for url in urls
+        ]
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self.clock = clock
+        self.in_use = [0] * len(self.engines)
+        self._next = itertools.cycle(range(len(self.engines)))
+        self._writes = OrderedDict()
+        self._lock = threading.Lock()
+        self._signer = URLSafeSerializer(secret, salt=REPLICA_STICKY_COOKIE)
+
+        for index, engine in enumerate(self.engines):
+            event.listen(engine, 'checkout',
+                         lambda *args, index=index: self._count(index, 1))
+            event.listen(engine, 'checkin',
+                         lambda *args, index=index: self._count(index, -1))
+
+    def _count(self, index, delta):
+        with self._lock:
+            self.in_use[index] += delta
+
+    def choose(self):
+        '''
+        Returns the replica engine for the next read only request
+        '''
+        with self._lock:
+            start = next(self._next)
+            if self.strategy == 'round_robin':
+                return self.engines[start]
+
+            # ties go round robin so idle replicas share the load
+            count = len(self.engines)
+            index = min(
+                ((start + offset) % count for offset in range(count)),
+                key=self.in_use.__getitem__)
+            return self.engines[index]
+
+    def mark_write(self, client):
+        '''
+        Starts the sticky window of a client and returns the signed
+        cookie value carrying its end
+        '''
+        with self._lock:
+            now = self.clock()
+            expires_at = now + self.sticky_seconds
+            # entries share one window, so the oldest expire first
+            while self._writes and next(iter(self._writes.values())) <= now:
+                self._writes.popitem(last=False)
+            self._writes.pop(client, None)
+            self._writes[client] = expires_at
+            while len(self._writes) > REPLICA_STICKY_SIZE:
+                self._writes.popitem(last=False)
+        return self._signer.dumps([client, expires_at])
+
+    def wrote_recently(self, client, cookie=None):
+        if cookie is not None and self._cookie_expires_at(client, cookie) \
+                > self.clock():
+            return True
+
+        with self._lock:
+            expires_at = self._writes.get(client)
+            if expires_at is None:
+                return False
+            if expires_at <= self.clock():
+                del self._writes[client]
+                return False
+            return True
+
+    def _cookie_expires_at(self, client, cookie):
+        try:
+            owner, expires_at = self._signer.loads(cookie)
+        except (BadSignature, TypeError, ValueError):
+            return 0
+        # a cookie set for another token doesn't make this one sticky
+        if owner != client or not isinstance(expires_at, (int, float)):
+            return 0
+        return expires_at
+
+    def init_app(self, app):
+        first = 'replicas' not in app.extensions
+        app.extensions['replicas'] = self
+        if not first:
+            return
+
+        @app.after_request
+        def remember_write(response):
+            router = app.extensions.get('replicas')
+            if router is not None and request.method not in READ_METHODS \
+                    and response.status_code < 400:
+                response.set_cookie(
+                    REPLICA_STICKY_COOKIE, router.mark_write(client_key()),
+                    max_age=max(1, round(router.sticky_seconds)),
+                    httponly=True, samesite='Lax')
+            return response
+
+
+def client_key():
+    '''
+    Identifies the client of the current request for read-your-writes
+    '''
+    authorization = request.headers.get('Authorization', None)
+    if authorization:
+        return token_key(authorization)
+    return request.remote_addr
+
+
+def read_only(f):
+    '''
+    Routes the queries of a view to a replica unless the client wrote
+    within the sticky window
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get('replicas')
+        cookie = request.cookies.get(REPLICA_STICKY_COOKIE)
+        if router is not None and \
+                not router.wrote_recently(client_key(), cookie):
+            g.read_replica = True
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    """RoutingSession
+    Sends the queries of read only requests to one replica per request,
+    flushes and all other requests go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        if router is not None and not self._flushing and \
+                has_request_context() and g.get('read_replica', False):
+            engine = g.get('replica_engine', None)
+            if engine is None:
+                engine = g.replica_engine = router.choose()
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
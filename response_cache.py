@@ -0,0 +1,233 @@
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request
+from serialization import preferred_format
+
+try:
+    import redis
+except ImportError:  # the shared backend is optional
+    redis = None
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', None)
+
+# tag version counters shared by the worker processes
+RESPONSE_CACHE_SLOTS = int(os.environ.get('RESPONSE_CACHE_SLOTS', 4096))
+
+# headers that are recomputed for every response
+UNCACHED_HEADERS = ('Content-Length', 'X-Cache')
+
+
+class SharedVersions:
+    """SharedVersions
+    Tag versions in shared memory, seen by every process forked after it
+    is created, e.g. the gunicorn workers of a preloaded app. Tags are
+    hashed into a fixed number of counters, two tags sharing one only
+    invalidate each other's entries more often.
+    """
+
+    def __init__(self, slots=RESPONSE_CACHE_SLOTS):
+        self.counters = multiprocessing.Array('q', slots)
+
+    def slot(self, tag):
+        return zlib.crc32(tag.encode('utf-8')) % len(self.counters)
+
+    def get(self, tags):
+        return [self.counters[self.slot(tag)] for tag in tags]
+
+    def bump(self, tag):
+        with self.counters.get_lock():
+            self.counters[self.slot(tag)] += 1
+
+
+class LRUBackend:
+    """LRUBackend
+    In-process backend, entries are evicted least recently used first.
+    Tag versions are kept apart from the entries so they are never
+    evicted, otherwise an old entry could become valid again. With
+    shared_versions an invalidation in one worker reaches the entries
+    of all workers, each still holding its own.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, clock=time.monotonic,
+                 shared_versions=None):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.shared_versions = shared_versions
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def versions(self, tags):
+        if self.shared_versions is not None:
+            return self.shared_versions.get(tags)
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tag):
+        if self.shared_versions is not None:
+            self.shared_versions.bump(tag)
+            return
+        with self._lock:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        # shared versions are never reset, entries of other workers
+        # would become valid again
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class RedisBackend:
+    """RedisBackend
+    Shared backend for all workers, takes any client with the redis-py
+    get/set/mget/incr interface.
+    """
+
+    def __init__(self, client, prefix='music-store:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def versions(self, tags):
+        values = self.client.mget([self.prefix + 'v:' + tag for tag in tags])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def bump(self, tag):
+        self.client.incr(self.prefix + 'v:' + tag)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    """ResponseCache
+    Read-through cache for GET responses.
+
+    Entries are keyed by path, query string and permission scope, and
+    carry the versions of the tags they depend on. Writes bump the
+    versions of the tags they affect, so only those entries stop being
+    served; they age out of the backend on their own.
+
+    Put it above @conditional: entries keep the ETag and Last-Modified
+    of the response, so a hit answers conditional requests without
+    touching the database.
+    """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, tags, scope):
+        versions = self.backend.versions(tags)
+        tagged = ','.join(f'{tag}@{version}'
+                          for tag, version in zip(tags, versions))
+        query = '&'.join(sorted(
+            f'{name}={value}'
+            for name, values in request.args.lists() for value in values))
+        return f'{request.path}?{query}|{preferred_format()}|{scope}|{tagged}'
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.bump(tag)
+        self.invalidations += 1
+
+    def cached(self, tags):
+        '''
+        Caches 200 responses of a view, tags(**view_args) returns the
+        tags the response depends on
+        '''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                scope = ' '.join(sorted(payload.get('permissions', [])))
+                key = self.key(tags(**kwargs), scope)
+
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    body, status, headers = entry
+                    response = Response(body, status, headers=headers)
+                    # 304 if If-None-Match or If-Modified-Since match the
+                    # ETag and Last-Modified kept in the entry
+                    response.make_conditional(request)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                self.misses += 1
+                response = make_response(f(payload, *args, **kwargs))
+                if response.status_code == 200 and \
+                        not response.is_streamed:
+                    headers = [
+                        (name, value) for name, value in response.headers
+                        if name not in UNCACHED_HEADERS
+                    ]
+                    self.backend.set(
+                        key,
+                        (response.get_data(), response.status_code, headers),
+                        self.ttl)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': getattr(self.backend, 'evictions', 0)
+        }
+
+
+def create_backend(url=RESPONSE_CACHE_URL):
+    '''
+    Uses the shared redis backend if RESPONSE_CACHE_URL is set, otherwise
+    an LRU per worker with tag versions shared by the workers forked
+    from this process
+    '''
+    if url and redis is not None:
+        return RedisBackend(redis.Redis.from_url(url))
+    return LRUBackend(shared_versions=SharedVersions())
+
+
+response_cache = ResponseCache(create_backend())
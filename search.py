@@ -0,0 +1,132 @@
+import re
+from flask import abort
+from sqlalchemy import text
+from models import db
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# longer queries are cut, typeahead never needs more terms
+SEARCH_MAX_TERMS = 8
+
+ALBUM_COLUMNS = ('id', 'title', 'year', 'artist', 'artist_id')
+ARTIST_COLUMNS = ('id', 'name')
+
+# search_vector is the stored column the GIN index covers (migration
+# 4e6a8c0b2d15), ranking reads it instead of parsing every match again
+POSTGRES_ALBUMS = '''
+    SELECT a.id, a.title, a.year, a.artist, a.artist_id
+    FROM albums a, to_tsquery('simple', :query) q
+    WHERE a.search_vector @@ q {filters}
+    ORDER BY ts_rank(a.search_vector, q) DESC, a.id
+    LIMIT :limit
+'''
+
+POSTGRES_ARTISTS = '''
+    SELECT r.id, r.name
+    FROM artists r, to_tsquery('simple', :query) q
+    WHERE r.search_vector @@ q {filters}
+    ORDER BY ts_rank(r.search_vector, q) DESC, r.id
+    LIMIT :limit
+'''
+
+SQLITE_ALBUMS = '''
+    SELECT a.id, a.title, a.year, a.artist, a.artist_id
+    FROM albums_fts f JOIN albums a ON a.id = f.rowid
+    WHERE albums_fts MATCH :query {filters}
+    ORDER BY f.rank, a.id
+    LIMIT :limit
+'''
+
+SQLITE_ARTISTS = '''
+    SELECT r.id, r.name
+    FROM artists_fts f JOIN artists r ON r.id = f.rowid
+    WHERE artists_fts MATCH :query {filters}
+    ORDER BY f.rank, r.id
+    LIMIT :limit
+'''
+
+ALBUM_YEAR_FILTERS = {
+    'year_from': 'AND a.year >= :year_from',
+    'year_to': 'AND a.year <= :year_to'
+}
+
+# artists match a year range through the albums linked to them
+ARTIST_YEAR_FILTER = '''
+    AND EXISTS (
+        SELECT 1 FROM albums a WHERE a.artist_id = r.id {filters}
+    )
+'''
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())[:SEARCH_MAX_TERMS]
+
+
+def postgres_terms(tokens, prefix):
+    terms = list(tokens)
+    if prefix:
+        terms[-1] += ':*'
+    return ' & '.join(terms)
+
+
+def sqlite_terms(tokens, prefix):
+    terms = ['"%s"' % token for token in tokens]
+    if prefix:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def get_search_args(args):
+    '''
+    Reads q, prefix, year_from, year_to and limit from the query string
+    '''
+    tokens = tokenize(args.get('q', ''))
+    if not tokens:
+        abort(400)
+
+    prefix = args.get('prefix', 'true').lower() not in ('false', '0')
+
+    try:
+        limit = int(args.get('limit', SEARCH_DEFAULT_LIMIT))
+        years = {key: int(args[key]) for key in ALBUM_YEAR_FILTERS
+                 if args.get(key)}
+    except ValueError:
+        abort(400)
+
+    if limit < 1:
+        abort(400)
+    return tokens, prefix, years, min(limit, SEARCH_MAX_LIMIT)
+
+
+def search_catalogue(tokens, prefix=True, years=None,
+                     limit=SEARCH_DEFAULT_LIMIT):
+    '''
+    Returns ranked albums and artists matching the search tokens
+    '''
+    years = years or {}
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        albums_sql, artists_sql = POSTGRES_ALBUMS, POSTGRES_ARTISTS
+        query = postgres_terms(tokens, prefix)
+    elif dialect == 'sqlite':
+        albums_sql, artists_sql = SQLITE_ALBUMS, SQLITE_ARTISTS
+        query = sqlite_terms(tokens, prefix)
+    else:
+        abort(500)
+
+    year_filters = ' '.join(ALBUM_YEAR_FILTERS[key] for key in years)
+    artist_filters = ARTIST_YEAR_FILTER.format(filters=year_filters) \
+        if years else ''
+
+    params = dict(years, query=query, limit=limit)
+    albums = db.session.execute(
+        text(albums_sql.format(filters=year_filters)), params)
+    artists = db.session.execute(
+        text(artists_sql.format(filters=artist_filters)), params)
+
+    return (
+        [dict(zip(ALBUM_COLUMNS, row)) for row in albums],
+        [dict(zip(ARTIST_COLUMNS, row)) for row in artists]
+    )
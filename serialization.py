@@ -0,0 +1,148 @@
+import io
+import json
+import os
+from flask import Response, abort, request
+from instrumentation import timed
+
+try:
+    import orjson
+except ImportError:  # the fast encoder is optional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # binary formats are optional
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+# rows per Arrow record batch
+ARROW_BATCH_SIZE = int(os.environ.get('ARROW_BATCH_SIZE', 10000))
+
+# Arrow column types by the python type of the model column
+ARROW_TYPES = {int: 'int64', str: 'string'}
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+# encoders by name, each turns a payload into UTF-8 JSON bytes
+JSON_BACKENDS = {'json': stdlib_dumps}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = orjson.dumps
+
+JSON_BACKEND = os.environ.get(
+    'JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+
+
+def dumps(obj):
+    '''
+    Encodes obj with the configured JSON backend, returns bytes
+    '''
+    return JSON_BACKENDS[JSON_BACKEND](obj)
+
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+# payload encoders by media type, JSON first so it wins for */*
+ENCODERS = {JSON: dumps}
+if msgpack is not None:
+    ENCODERS[MSGPACK] = msgpack_dumps
+
+# media types the list routes can answer with
+LIST_FORMATS = list(ENCODERS) + ([ARROW] if pyarrow is not None else [])
+
+
+def preferred_format(formats=LIST_FORMATS):
+    '''
+    Returns the best media type for the request's Accept header, JSON
+    when there is none and None when nothing is acceptable
+    '''
+    if not request.accept_mimetypes:
+        return JSON
+    return request.accept_mimetypes.best_match(formats)
+
+
+def negotiate(formats=LIST_FORMATS):
+    '''
+    Like preferred_format but aborts with 406 if nothing is acceptable
+    '''
+    mimetype = preferred_format(formats)
+    if mimetype is None:
+        abort(406)
+    return mimetype
+
+
+def json_response(payload, status=200):
+    '''
+    Like jsonify but encoded with the configured JSON backend
+    '''
+    with timed('serialize'):
+        body = dumps(payload)
+    return Response(body, status=status, mimetype=JSON)
+
+
+def encoded_response(payload, mimetype=JSON, status=200):
+    '''
+    Encodes payload as mimetype, one of ENCODERS
+    '''
+    with timed('serialize'):
+        body = ENCODERS[mimetype](payload)
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def arrow_schema(model, fields):
+    return pyarrow.schema([
+        (name, getattr(pyarrow, ARROW_TYPES[
+            getattr(model, name).type.python_type])())
+        for name in fields
+    ])
+
+
+def arrow_stream(rows, schema, batch_size=ARROW_BATCH_SIZE):
+    '''
+    Yields an Arrow IPC stream of tuple rows, one record batch per chunk,
+    so only one batch is held in memory
+    '''
+    sink = io.BytesIO()
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    def write(writer, batch):
+        columns = list(zip(*batch))
+        writer.write_batch(pyarrow.record_batch([
+            pyarrow.array(column, type=field.type)
+            for column, field in zip(columns, schema)
+        ], schema=schema))
+
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    yield drain()
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            write(writer, batch)
+            batch = []
+            yield drain()
+
+    if batch:
+        write(writer, batch)
+    writer.close()
+    yield drain()
@@ -0,0 +1,48 @@
+from models import db, CatalogueStat
+
+# recount everything, the statements must match migration 5e8a0d2c4f61
+REBUILD = [
+    "DELETE FROM catalogue_stats",
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'total', '', count(*) FROM albums",
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'artist', artist, count(*) FROM albums GROUP BY artist",
+    "INSERT INTO catalogue_stats (dimension, bucket, albums) "
+    "SELECT 'decade', CAST(year / 10 * 10 AS VARCHAR(16)), count(*) "
+    "FROM albums GROUP BY year / 10 * 10",
+]
+
+
+def rebuild_stats():
+    '''
+    Recomputes the catalogue statistics from the albums table in one
+    transaction, album writes wait for it on PostgreSQL
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('LOCK TABLE albums IN SHARE MODE')
+    for statement in REBUILD:
+        db.session.execute(statement)
+    db.session.commit()
+
+
+def catalogue_stats():
+    '''
+    Reads the precomputed statistics, a lookup of one small table
+    instead of scans of albums
+    '''
+    stats = {'albums': 0, 'decades': [], 'artists': []}
+    rows = db.session.query(
+        CatalogueStat.dimension, CatalogueStat.bucket, CatalogueStat.albums
+    ).filter(CatalogueStat.albums > 0)
+
+    for dimension, bucket, albums in rows:
+        if dimension == 'total':
+            stats['albums'] = albums
+        elif dimension == 'decade':
+            stats['decades'].append({'decade': int(bucket), 'albums': albums})
+        else:
+            stats['artists'].append({'artist': bucket, 'albums': albums})
+
+    stats['decades'].sort(key=lambda row: row['decade'])
+    stats['artists'].sort(key=lambda row: (-row['albums'], row['artist']))
+    return stats
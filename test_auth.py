@@ -0,0 +1,300 @@
+import json
+import os
+import tempfile
+import unittest
+
+import auth
+from jwks import JWKSCache, file_fetcher, key_source, url_fetcher
+from token_cache import TokenCache
+from benchmarks.issuer import LocalIssuer
+
+
+def make_jwks(*kids):
+    return {'keys': [
+        {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid, 'e': 'AQAB'}
+        for kid in kids
+    ]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class StubFetcher:
+    def __init__(self, *kids):
+        self.jwks = make_jwks(*kids)
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise OSError('issuer unreachable')
+        return self.jwks
+
+
+class JWKSCacheTest(unittest.TestCase):
+    """Setup test suite for the JWKS key cache"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fetcher = StubFetcher('key-1')
+        self.cache = JWKSCache(
+            self.fetcher,
+            ttl=600,
+            refresh_ahead=60,
+            min_refetch_interval=30,
+            background=False,
+            clock=self.clock
+        )
+
+    # Tests that keys are fetched once and served from memory
+    def test_get_key_is_cached(self):
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.fetcher.calls, 1)
+
+    # Tests that keys are refreshed once the ttl has passed
+    def test_refresh_after_ttl(self):
+        self.cache.get_key('key-1')
+        self.clock.now = 601
+        self.cache.get_key('key-1')
+        self.assertEqual(self.fetcher.calls, 2)
+
+    # Tests that keys are refreshed ahead of expiry
+    def test_refresh_ahead_of_expiry(self):
+        self.cache.get_key('key-1')
+        self.clock.now = 550
+        self.cache.get_key('key-1')
+        self.assertEqual(self.fetcher.calls, 2)
+        self.assertFalse(self.cache.is_stale)
+
+    # Tests that an unknown kid refetches once and is rate limited
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key('key-1')
+        self.clock.now = 31
+        self.fetcher.jwks = make_jwks('key-1', 'key-2')
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.fetcher.calls, 2)
+
+        self.assertIsNone(self.cache.get_key('key-3'))
+        self.assertIsNone(self.cache.get_key('key-3'))
+        self.assertEqual(self.fetcher.calls, 2)
+
+    # Tests that stale keys are served when the issuer is unreachable
+    def test_serves_stale_keys_on_failure(self):
+        self.cache.get_key('key-1')
+        self.fetcher.fail = True
+        self.clock.now = 700
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertTrue(self.cache.is_stale)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['keys'], 1)
+        self.assertEqual((stats['refreshes'], stats['failures']), (1, 1))
+
+    # Tests that keys can be loaded from a local JWKS file
+    def test_file_fetcher(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as jwks_file:
+            json.dump(make_jwks('local'), jwks_file)
+        self.addCleanup(os.remove, jwks_file.name)
+
+        cache = JWKSCache(file_fetcher(jwks_file.name))
+        self.assertEqual(cache.get_key('local')['n'], 'n-local')
+
+    # Tests that a local key file is reloaded when it changes
+    def test_file_hot_reload(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as jwks_file:
+            json.dump(make_jwks('old'), jwks_file)
+        self.addCleanup(os.remove, jwks_file.name)
+
+        cache = JWKSCache(file_fetcher(jwks_file.name, check_interval=0))
+        self.assertIsNotNone(cache.get_key('old'))
+        with open(jwks_file.name, 'w') as rotated:
+            json.dump(make_jwks('new-key'), rotated)
+
+        self.assertIsNotNone(cache.get_key('new-key'))
+        self.assertNotIn('old', cache.keys)
+
+    # Tests that PEM bundles are keyed by their thumbprints
+    def test_pem_bundle(self):
+        issuers = [LocalIssuer('issuer', 'audience', bits=1024)
+                   for _ in range(2)]
+        with tempfile.NamedTemporaryFile('w', suffix='.pem',
+                                         delete=False) as pem_file:
+            pem_file.write('\n'.join(issuer.public_pem
+                                     for issuer in issuers))
+        self.addCleanup(os.remove, pem_file.name)
+
+        cache = JWKSCache(key_source(pem_file.name))
+        for issuer in issuers:
+            self.assertEqual(cache.get_key(issuer.kid)['n'],
+                             issuer.jwks['keys'][0]['n'])
+
+
+class TokenCacheTest(unittest.TestCase):
+    """Setup test suite for the verified token cache"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TokenCache(maxsize=2, clock=self.clock)
+
+    # Tests that a cached payload is returned until its exp claim
+    def test_hit_until_exp(self):
+        self.cache.set('token-a', {'exp': 100, 'permissions': []})
+        self.assertEqual(self.cache.get('token-a')['exp'], 100)
+        self.clock.now = 100
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Tests that the least recently used entry is evicted
+    def test_lru_eviction(self):
+        self.cache.set('token-a', {'exp': 100})
+        self.cache.set('token-b', {'exp': 100})
+        self.cache.get('token-a')
+        self.cache.set('token-c', {'exp': 100})
+        self.assertIsNone(self.cache.get('token-b'))
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.evictions, 1)
+
+    # Tests that entries signed by a rotated key are purged
+    def test_purge_by_kid(self):
+        self.cache.set('token-a', {'exp': 100}, kid='key-1')
+        self.cache.set('token-b', {'exp': 100}, kid='key-2')
+        self.cache.purge(['key-1'])
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertIsNotNone(self.cache.get('token-b'))
+
+    # Tests that a key rotation in the JWKS cache purges its tokens
+    def test_purge_on_rotate(self):
+        self.cache.set('token-a', {'exp': 100}, kid='key-1')
+        fetcher = StubFetcher('key-1')
+        jwks_cache = JWKSCache(fetcher, on_rotate=self.cache.purge)
+        jwks_cache.refresh()
+        fetcher.jwks = make_jwks('key-2')
+        jwks_cache.refresh()
+        self.assertEqual(len(self.cache), 0)
+
+    # Tests that a kid that comes back with another key purges its tokens
+    def test_purge_on_replaced_key(self):
+        self.cache.set('token-a', {'exp': 100}, kid='key-1')
+        fetcher = StubFetcher('key-1')
+        jwks_cache = JWKSCache(fetcher, on_rotate=self.cache.purge)
+        jwks_cache.refresh()
+        fetcher.jwks['keys'][0]['n'] = 'n-other'
+        jwks_cache.refresh()
+        self.assertEqual(len(self.cache), 0)
+
+
+class PermissionsTest(unittest.TestCase):
+    """Setup test suite for permission checks"""
+
+    # Tests that verified claims carry their permissions as a set
+    def test_claims_freeze_permissions(self):
+        claims = auth.Claims({'permissions': ['get:albums', 'get:albums']})
+        self.assertEqual(claims.granted, frozenset(['get:albums']))
+        self.assertEqual(claims['permissions'], ['get:albums', 'get:albums'])
+        self.assertTrue(auth.check_permissions('get:albums', claims))
+
+    # Tests that an action wildcard grants every permission of the action
+    def test_wildcard(self):
+        claims = auth.Claims({'permissions': ['get:*']})
+        self.assertTrue(auth.check_permissions('get:artists', claims))
+        with self.assertRaises(auth.AuthError) as error:
+            auth.check_permissions('post:artists', claims)
+        self.assertEqual(error.exception.status_code, 401)
+
+    # Tests that a payload without permissions is rejected
+    def test_permissions_missing(self):
+        for payload in ({}, auth.Claims({})):
+            with self.assertRaises(auth.AuthError) as error:
+                auth.check_permissions('get:albums', payload)
+            self.assertEqual(error.exception.status_code, 400)
+
+
+class LocalIssuerTest(unittest.TestCase):
+    """Setup test suite for the benchmark's issuer stand-in"""
+
+    def setUp(self):
+        self.issuer = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE,
+                                  bits=1024).start()
+        self.addCleanup(self.issuer.stop)
+
+        fetcher = auth.jwks_cache.fetcher
+        auth.jwks_cache.fetcher = url_fetcher(self.issuer.jwks_url)
+        auth.jwks_cache.clear()
+        self.addCleanup(setattr, auth.jwks_cache, 'fetcher', fetcher)
+        self.addCleanup(auth.jwks_cache.clear)
+
+    # Tests that minted tokens verify against the served JWKS
+    def test_token_verifies(self):
+        payload = auth.verify_decode_jwt(
+            self.issuer.token(permissions=['get:albums']))
+        self.assertEqual(payload['permissions'], ['get:albums'])
+        self.assertEqual(payload.granted, frozenset(['get:albums']))
+
+    # Tests that a cached token is rejected once its key is rotated out
+    def test_cached_token_after_rotation(self):
+        token = self.issuer.token()
+        auth.verify_decode_jwt(token)
+
+        other = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE, bits=1024)
+        auth.jwks_cache.fetcher = lambda: other.jwks
+        clock = auth.jwks_cache.clock
+        auth.jwks_cache.clock = lambda: clock() + auth.jwks_cache.ttl
+        self.addCleanup(setattr, auth.jwks_cache, 'clock', clock)
+
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(token)
+
+    # Tests that expired tokens are rejected
+    def test_expired_token(self):
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(self.issuer.token(expires_in=-60))
+
+    # Tests that tokens verify offline against a written key file
+    def test_token_verifies_with_key_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.pem',
+                                         delete=False) as pem_file:
+            pass
+        self.addCleanup(os.remove, pem_file.name)
+        self.issuer.write_keys(pem_file.name, fmt='pem')
+        auth.jwks_cache.fetcher = key_source(pem_file.name)
+
+        payload = auth.verify_decode_jwt(
+            self.issuer.token(permissions=['get:*']))
+        self.assertTrue(auth.check_permissions('get:artists', payload))
+
+    # Tests that replacing the key file rejects tokens already cached
+    def test_key_file_replaced(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as jwks_file:
+            pass
+        self.addCleanup(os.remove, jwks_file.name)
+        self.issuer.write_keys(jwks_file.name)
+        auth.jwks_cache.fetcher = key_source(jwks_file.name)
+        auth.jwks_cache.fetcher.check_interval = 0
+        token = self.issuer.token()
+        auth.verify_decode_jwt(token)
+
+        # same kid, another key
+        other = LocalIssuer(auth.AUTH_ISSUER, auth.AUTH_AUDIENCE,
+                            kid=self.issuer.kid, bits=1024)
+        other.write_keys(jwks_file.name)
+        os.utime(jwks_file.name, ns=(0, 0))
+
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(token)
+        self.assertTrue(auth.verify_decode_jwt(other.token()))
+
+
+# Make the tests executable
+if __name__ == "__main__":
+    unittest.main()
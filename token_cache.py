@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def token_key(token):
+    '''
+    Returns the cache key for a raw bearer token
+    '''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    """TokenCache
+    Bounded LRU cache of verified token payloads keyed by token hash.
+
+    Each entry expires at the token's exp claim, so a cached payload is
+    never served for a token jwt.decode would reject as expired.
+    """
+
+    def __init__(self, maxsize=4096, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token):
+        '''
+        Returns the cached payload for token or None
+        '''
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at, kid = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload, kid=None):
+        '''
+        Caches a verified payload until its exp claim
+        '''
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+
+        key = token_key(token)
+        with self._lock:
+            self._entries[key] = (payload, payload['exp'], kid)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def purge(self, kids=None):
+        '''
+        Drops every entry, or only the entries signed by the given kids
+        '''
+        with self._lock:
+            if kids is None:
+                self._entries.clear()
+                return
+
+            kids = set(kids)
+            for key in [key for key, entry in self._entries.items()
+                        if entry[2] in kids]:
+                del self._entries[key]
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from sqlalchemy import orm
+from sqlalchemy.pool import QueuePool
+
+# set to false to start workers cold, e.g. for one-off commands
+WARMUP = os.environ.get('WARMUP', 'true').lower() in ('1', 'true', 'yes')
+
+# connections opened per engine, the pool size by default
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 0))
+
+logger = logging.getLogger('music_store.boot')
+
+
+@contextmanager
+def step(timings, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - started) * 1000, 3)
+
+
+def log_boot(event, timings):
+    logger.info(json.dumps(dict(timings, event=event, pid=os.getpid())))
+
+
+def engines(app):
+    '''
+    Returns the primary engine of app followed by its replica engines
+    '''
+    from models import db
+
+    router = app.extensions.get('replicas')
+    return [db.get_engine(app)] + (list(router.engines) if router else [])
+
+
+def reset_connections(app):
+    '''
+    Drops pooled connections, a forked worker must not reuse the sockets
+    of its parent
+    '''
+    for engine in engines(app):
+        engine.dispose()
+
+
+def open_connections(engine, count=WARMUP_CONNECTIONS):
+    '''
+    Checks out count connections at once and returns them to the pool,
+    so they stay open for the first requests
+    '''
+    if not count:
+        count = engine.pool.size() if isinstance(engine.pool, QueuePool) \
+            else 1
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return count
+
+
+def hot_queries():
+    '''
+    The statements behind the most requested routes
+    '''
+    from catalogue import count_query
+    from conditional import collection_state, row_state
+    from models import Album, Artist
+    from pagination import keyset_rows
+    from stats import catalogue_stats
+
+    return [
+        lambda: keyset_rows(Album, Album.public_fields, limit=1),
+        lambda: keyset_rows(Artist, Artist.public_fields, limit=1),
+        lambda: row_state(Album, 1),
+        lambda: row_state(Artist, 1),
+        lambda: collection_state(Album),
+        lambda: collection_state(Artist),
+        lambda: count_query('year').all(),
+        catalogue_stats
+    ]
+
+
+def warm_up(app, connections=True, jwks=True, queries=True):
+    '''
+    Prepares app for its first requests: fetches the signing keys,
+    configures the mappers, opens pool connections and runs the hot
+    queries once. Returns the time of each step in ms, which is also
+    logged on the music_store.boot logger.
+
+    With gunicorn --preload the master calls this without connections
+    and queries, so every worker inherits the keys and mappers, and each
+    worker calls it with them after the fork.
+    A failing step is logged and skipped, the worker still starts.
+    '''
+    from auth import jwks_cache
+    from models import db
+
+    timings = {}
+    with step(timings, 'total_ms'):
+        if jwks and jwks_cache.is_stale:
+            with step(timings, 'jwks_ms'):
+                if not jwks_cache.refresh():
+                    logger.warning('JWKS prefetch failed, the first '
+                                   'request will retry it')
+
+        with step(timings, 'mappers_ms'):
+            orm.configure_mappers()
+
+        try:
+            if connections:
+                with step(timings, 'connections_ms'):
+                    timings['connections'] = sum(
+                        open_connections(engine) for engine in engines(app))
+
+            if queries:
+                # the ETag helpers read the request, an empty one will do
+                with step(timings, 'queries_ms'), \
+                        app.test_request_context():
+                    try:
+                        for query in hot_queries():
+                            query()
+                    finally:
+                        db.session.remove()
+        except Exception:
+            logger.exception('warm-up failed, connections are opened by '
+                             'the first requests')
+
+    log_boot('warm_up', timings)
+    return timings